@@ -0,0 +1,220 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stand-ins for iLoop and the model service, serving synthetic but realistically sized data with a configurable
+latency. iLoop is served the way Flask-Potion does, so that potion_client can be used against it unchanged."""
+
+import asyncio
+import json
+import random
+
+import msgpack
+from aiohttp import web
+from model_transport import synthetic_model
+
+
+class Dataset(object):
+    """iLoop content: experiments with sample groups (replicates of a strain in a medium), every strain at the end of
+    a lineage of strains and pools, and measurements for every sample and phase"""
+
+    def __init__(self, experiments=4, groups=8, replicates=3, phases=4, lineage=10, compounds=12, xrefs=20, seed=0):
+        rng = random.Random(seed)
+        self.resources = {name: {} for name in (
+            'organism', 'compound', 'phase', 'pool', 'strain', 'medium', 'experiment', 'sample')}
+        self.scalars = {}
+        self.xrefs = {}
+        self.groups = []
+        self.add('organism', 1, short_code='ECO', name='Escherichia coli')
+        compound_ids = [16828 + i for i in range(compounds + 10)]
+        for chebi_id in compound_ids:
+            self.add('compound', chebi_id, chebi_id=chebi_id, chebi_name='compound {}'.format(chebi_id))
+        for phase in range(1, phases + 1):
+            self.add('phase', phase, title='phase {}'.format(phase), start=(phase - 1) * 10, end=phase * 10)
+        for medium in range(1, 3):
+            self.add('medium', medium, name='medium {}'.format(medium),
+                     contents=[{'compound': ref('compound', chebi_id), 'concentration': rng.random()}
+                               for chebi_id in compound_ids[-10:]])
+        sample_id = 0
+        for experiment in range(1, experiments + 1):
+            self.add('experiment', experiment, identifier='experiment {}'.format(experiment), type='fermentation',
+                     attributes={'conditions': {'gas': 'air'}, 'operation': {}}, samples=[])
+            for group in range(groups):
+                strain = self.add_lineage(experiment * 1000 + group * lineage, lineage)
+                sample_ids = []
+                for replicate in range(replicates):
+                    sample_id += 1
+                    sample_ids.append(sample_id)
+                    self.add('sample', sample_id, name='S{}'.format(sample_id), strain=ref('strain', strain),
+                             medium=ref('medium', 1 + group % 2), feed_medium=None,
+                             experiment=ref('experiment', experiment))
+                    self.resources['experiment'][experiment]['samples'].append(sample_id)
+                    self.scalars[sample_id] = [
+                        scalar(phase, chebi_id, rng) for phase in range(1, phases + 1)
+                        for chebi_id in compound_ids[:compounds]] + [growth_rate(phase, rng)
+                                                                     for phase in range(1, phases + 1)]
+                    self.xrefs[sample_id] = [{
+                        'accession': 'R{}'.format(i), 'value': rng.random(), 'mode': 'quantitative',
+                        'db_name': 'bigg.reaction', 'phase': ref('phase', phase),
+                    } for phase in range(1, phases + 1) for i in range(xrefs)]
+                self.groups.append(sample_ids)
+
+    def add(self, resource, id, **properties):
+        self.resources[resource][id] = dict(properties, **{'$uri': '/api/{}/{}'.format(resource, id)})
+        return id
+
+    def add_lineage(self, first_id, depth):
+        parent_pool = parent_strain = None
+        for i in range(first_id, first_id + depth):
+            self.add('pool', i, identifier='pool {}'.format(i), genotype='+gene{}'.format(i),
+                     parent_pool=parent_pool and ref('pool', parent_pool))
+            self.add('strain', i, genotype='+gene{}_s'.format(i), organism=ref('organism', 1), pool=ref('pool', i),
+                     parent_strain=parent_strain and ref('strain', parent_strain))
+            parent_pool = parent_strain = i
+        return parent_strain
+
+
+def ref(resource, id):
+    return {'$ref': '/api/{}/{}'.format(resource, id)}
+
+
+def scalar(phase, chebi_id, rng):
+    return {
+        'measurements': [rng.uniform(0, 5), rng.uniform(0, 5)],
+        'phase': ref('phase', phase),
+        'test': {
+            'type': rng.choice(['uptake-rate', 'production-rate']), 'rate': 'h',
+            'numerator': {'compartment': None, 'compounds': [ref('compound', chebi_id)], 'quantity': 'amount',
+                          'unit': 'mmol'},
+            'denominator': {'compartment': None, 'compounds': [], 'quantity': 'CDW', 'unit': 'g'},
+        },
+    }
+
+
+def growth_rate(phase, rng):
+    return {
+        'measurements': [rng.uniform(0, 1)],
+        'phase': ref('phase', phase),
+        'test': {'type': 'growth-rate', 'rate': 'h', 'numerator': None, 'denominator': None},
+    }
+
+
+ROUTES = {
+    'sample': [('readScalars', 'scalars'), ('readXrefMeasurements', 'xref-measurements')],
+    'experiment': [('readSamples', 'samples')],
+    'medium': [('readContents', 'contents')],
+}
+HIDDEN = {'contents', 'samples'}
+
+
+def resource_schema(name, dataset):
+    properties = {key: {} for item in dataset.resources[name].values() for key in item if key not in HIDDEN}
+    links = [
+        {'rel': 'self', 'href': '/api/{}/{{id}}'.format(name), 'method': 'GET'},
+        {'rel': 'instances', 'href': '/api/{}'.format(name), 'method': 'GET',
+         'schema': {'type': 'object', 'properties': {'page': {}, 'per_page': {}, 'where': {}, 'sort': {}}}},
+    ]
+    links += [{'rel': rel, 'href': '/api/{}/{{id}}/{}'.format(name, path), 'method': 'GET', 'schema': {}}
+              for rel, path in ROUTES.get(name, [])]
+    return {'type': 'object', 'properties': properties, 'links': links}
+
+
+def public(item):
+    return {key: value for key, value in item.items() if key not in HIDDEN}
+
+
+def fake_iloop(dataset, latency=0.005):
+    """Potion-style iLoop API at /api"""
+    async def respond(data, **headers):
+        await asyncio.sleep(latency)
+        return web.json_response(data, headers=headers)
+
+    async def root_schema(request):
+        return await respond({'properties': {name: {'$ref': '/api/{}/schema#'.format(name)}
+                                             for name in dataset.resources}})
+
+    async def schema(request):
+        return await respond(resource_schema(request.match_info['resource'], dataset))
+
+    async def instances(request):
+        items = list(dataset.resources[request.match_info['resource']].values())
+        where = json.loads(request.query.get('where', '{}'))
+        items = [item for item in items if all(item.get(key) == value for key, value in where.items())]
+        page, per_page = int(request.query.get('page', 1)), int(request.query.get('per_page', 20))
+        return await respond([public(item) for item in items[(page - 1) * per_page:page * per_page]],
+                             **{'X-Total-Count': str(len(items))})
+
+    async def instance(request):
+        items = dataset.resources[request.match_info['resource']]
+        item = items.get(int(request.match_info['id']))
+        if item is None:
+            raise web.HTTPNotFound()
+        return await respond(public(item))
+
+    async def route(request):
+        resource, id, path = request.match_info['resource'], int(request.match_info['id']), request.match_info['path']
+        if (resource, path) == ('sample', 'scalars'):
+            return await respond(dataset.scalars[id])
+        if (resource, path) == ('sample', 'xref-measurements'):
+            subject_type = json.loads(request.query.get('type', '""'))
+            return await respond(dataset.xrefs[id] if subject_type == 'reaction' else [])
+        if (resource, path) == ('experiment', 'samples'):
+            return await respond([public(dataset.resources['sample'][i])
+                                  for i in dataset.resources['experiment'][id]['samples']])
+        if (resource, path) == ('medium', 'contents'):
+            return await respond(dataset.resources['medium'][id]['contents'])
+        raise web.HTTPNotFound()
+
+    app = web.Application()
+    app.router.add_get('/api/schema', root_schema)
+    app.router.add_get('/api/{resource}/schema', schema)
+    app.router.add_get('/api/{resource}', instances)
+    app.router.add_get('/api/{resource}/{id:\\d+}', instance)
+    app.router.add_get('/api/{resource}/{id:\\d+}/{path}', route)
+    return app
+
+
+def fake_model_service(reactions=2583, latency=0.5):
+    """Model service answering every simulation with the same genome-scale model and fluxes, in JSON or msgpack"""
+    model = synthetic_model(reactions=reactions, metabolites=reactions * 7 // 10, genes=reactions // 2)
+    rng = random.Random(0)
+    fluxes = {reaction['id']: rng.uniform(-10, 10) for reaction in model['reactions']}
+
+    def tmy(compound):
+        points = [rng.random() for _ in range(20)]
+        return {'objective_upper_bound': points, 'objective_lower_bound': points, compound: points}
+
+    async def simulate(request):
+        message = (await request.json())['message']
+        await asyncio.sleep(latency)
+        result = {'model-id': request.match_info['model_id']}
+        for key in message.get('to-return', []):
+            if key == 'model':
+                result[key] = model
+            elif key == 'fluxes':
+                result[key] = fluxes
+            elif key == 'growth-rate':
+                result[key] = 0.87
+            elif key == 'tmy':
+                result[key] = {compound: tmy(compound) for compound in message.get('theoretical-objectives', [])}
+        if 'msgpack' in request.headers.get('Accept', ''):
+            return web.Response(body=msgpack.packb(result), content_type='application/msgpack')
+        return web.json_response(result)
+
+    async def model_options(request):
+        return web.json_response(['iJO1366', 'e_coli_core'])
+
+    app = web.Application()
+    app.router.add_post('/models/{model_id}', simulate)
+    app.router.add_get('/model-options/{species}', model_options)
+    return app
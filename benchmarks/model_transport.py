@@ -0,0 +1,94 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare JSON and msgpack for model service responses: encoded size and time to encode and decode.
+
+Without arguments a synthetic response the size of iJO1366 (2583 reactions, 1805 metabolites, 1367 genes) with
+fluxes is used, a serialized cobra model can be given instead:
+
+    python benchmarks/model_transport.py [iJO1366.json]
+"""
+
+import json
+import random
+import sys
+import timeit
+
+import msgpack
+
+
+def synthetic_model(reactions=2583, metabolites=1805, genes=1367, seed=0):
+    rng = random.Random(seed)
+    metabolite_ids = ['met_{}_c'.format(i) for i in range(metabolites)]
+    gene_ids = ['b{:04d}'.format(i) for i in range(genes)]
+    return {
+        'id': 'iJO1366',
+        'reactions': [{
+            'id': 'RXN_{}'.format(i),
+            'name': 'Reaction number {}'.format(i),
+            'metabolites': {m: rng.choice([-2.0, -1.0, 1.0, 2.0]) for m in rng.sample(metabolite_ids, 4)},
+            'lower_bound': rng.choice([-1000.0, 0.0]),
+            'upper_bound': 1000.0,
+            'gene_reaction_rule': ' or '.join(rng.sample(gene_ids, rng.randint(0, 3))),
+            'subsystem': 'Subsystem {}'.format(i % 40),
+        } for i in range(reactions)],
+        'metabolites': [{
+            'id': m,
+            'name': 'Metabolite {}'.format(m),
+            'compartment': 'c',
+            'formula': 'C{}H{}O{}'.format(rng.randint(1, 20), rng.randint(1, 40), rng.randint(0, 10)),
+            'charge': rng.randint(-3, 1),
+        } for m in metabolite_ids],
+        'genes': [{'id': g, 'name': 'gene{}'.format(g)} for g in gene_ids],
+        'compartments': {'c': 'cytosol', 'e': 'extracellular space', 'p': 'periplasm'},
+    }
+
+
+def model_response(model):
+    rng = random.Random(1)
+    return {
+        'model-id': model['id'],
+        'model': model,
+        'fluxes': {r['id']: rng.uniform(-10, 10) for r in model['reactions']},
+        'growth-rate': 0.87,
+    }
+
+
+def best_of(function, number, repeat=5):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1000
+
+
+def main(path=None):
+    if path:
+        with open(path) as f:
+            model = json.load(f)
+    else:
+        model = synthetic_model()
+    payloads = [('fluxes', {'model-id': model['id'], 'fluxes': model_response(model)['fluxes']}),
+                ('model + fluxes', model_response(model))]
+    codecs = [
+        ('json', lambda obj: json.dumps(obj).encode(), lambda data: json.loads(data.decode())),
+        ('msgpack', msgpack.packb, lambda data: msgpack.unpackb(data, raw=False)),
+    ]
+    print('{:<16}{:<10}{:>12}{:>14}{:>14}'.format('payload', 'codec', 'bytes', 'encode (ms)', 'decode (ms)'))
+    for name, payload in payloads:
+        for codec, encode, decode in codecs:
+            data = encode(payload)
+            assert decode(data) == payload
+            print('{:<16}{:<10}{:>12}{:>14.2f}{:>14.2f}'.format(
+                name, codec, len(data), best_of(lambda: encode(payload), 10), best_of(lambda: decode(data), 10)))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
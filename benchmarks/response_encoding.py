@@ -0,0 +1,74 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare venom's JSONProtocol with FastJSONProtocol for the heavy responses: models with fluxes, fluxes only and
+maximum yields, for three phases of an iJO1366-sized model.
+
+    PYTHONPATH=src python benchmarks/response_encoding.py
+"""
+
+import random
+
+from model_transport import best_of, model_response, synthetic_model
+from venom.common.messages import JSONValue
+from venom.protocol import JSONProtocol
+
+from iloop_to_model.protocol import FastJSONProtocol
+from iloop_to_model.stubs import (
+    MaximumYieldMessage, MaximumYieldsMessage, MetabolitePhasePlaneMessage, ModelMessage, ModelsMessage,
+    PhasePlaneMessage, PhasePlanesMessage)
+
+
+def phase_plane(rng):
+    return PhasePlaneMessage(
+        objective_upper_bound=[rng.random() for _ in range(20)],
+        objective_lower_bound=[rng.random() for _ in range(20)],
+        objective=[rng.random() for _ in range(20)],
+        objective_id='EX_glc__D_e',
+    )
+
+
+def main(phases=3):
+    rng = random.Random(0)
+    response = model_response(synthetic_model())
+    messages = [
+        ('model + fluxes', ModelsMessage(response={phase: ModelMessage(
+            model=JSONValue(response['model']),
+            model_id=response['model-id'],
+            growth_rate=response['growth-rate'],
+            fluxes=response['fluxes'],
+        ) for phase in range(phases)})),
+        ('fluxes', ModelsMessage(response={phase: ModelMessage(
+            model_id=response['model-id'],
+            fluxes=response['fluxes'],
+        ) for phase in range(phases)})),
+        ('maximum yields', MaximumYieldsMessage(response={phase: MaximumYieldMessage(
+            growth_rate=[rng.random() for _ in range(10)],
+            metabolites={'metabolite {}'.format(i): MetabolitePhasePlaneMessage(
+                flux=[rng.random() for _ in range(10)],
+                phase_planes=PhasePlanesMessage(wild=phase_plane(rng), modified=phase_plane(rng)),
+            ) for i in range(30)},
+        ) for phase in range(phases)})),
+    ]
+    print('{:<16}{:>12}{:>16}{:>16}'.format('response', 'bytes', 'venom (ms)', 'fast (ms)'))
+    for name, message in messages:
+        venom, fast = JSONProtocol(type(message)), FastJSONProtocol(type(message))
+        data = fast.pack(message)
+        assert data == venom.pack(message)
+        print('{:<16}{:>12}{:>16.2f}{:>16.2f}'.format(
+            name, len(data), best_of(lambda: venom.pack(message), 5), best_of(lambda: fast.pack(message), 5)))
+
+
+if __name__ == '__main__':
+    main()
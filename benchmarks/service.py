@@ -0,0 +1,217 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Drive the endpoints of iloop-to-model, running against local stand-ins for iLoop and the model service (see
+fakes.py), at several concurrency levels. For every endpoint and level the throughput, the median and 99th
+percentile latency, the number of failed requests and the peak resident memory of the service are reported.
+
+    PYTHONPATH=src python benchmarks/service.py --concurrency 1 8 32 --requests 64 --json results.json
+
+Sample groups are requested in turn, so the first requests of an endpoint find cold caches and the later ones warm
+caches, unless there are more groups than requests. Settings of the service can be given with --env, e.g.
+--env MODEL_CACHE_SIZE=0 to always call the model service."""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import time
+from itertools import cycle
+
+import aiohttp
+from aiohttp import web
+from fakes import Dataset, fake_iloop, fake_model_service
+
+
+ENDPOINTS = {
+    'experiments': ('GET', '/iloop-to-model/experiments', None),
+    'samples': ('GET', '/iloop-to-model/experiments/{experiment}/samples', None),
+    'phases': ('POST', '/iloop-to-model/samples/phases', {}),
+    'info': ('POST', '/iloop-to-model/samples/info', {}),
+    'fluxes': ('POST', '/iloop-to-model/data-adjusted/fluxes', {'modelId': 'iJO1366'}),
+    'maximum-yield': ('POST', '/iloop-to-model/data-adjusted/maximum-yield', {'modelId': 'iJO1366'}),
+    'model': ('POST', '/iloop-to-model/data-adjusted/model', {'modelId': 'iJO1366', 'withFluxes': True}),
+    'model-diff': ('POST', '/iloop-to-model/data-adjusted/model/diff', {'modelId': 'iJO1366', 'withFluxes': True}),
+    'fluxes-batch': ('POST', '/iloop-to-model/data-adjusted/fluxes/batch', {'modelId': 'iJO1366'}),
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(app_factory, port, *args):
+    web.run_app(app_factory(*args), host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def service_app(env):
+    os.environ.update(env)
+    from iloop_to_model.app import get_app
+    return get_app()
+
+
+def start(target, *args):
+    process = multiprocessing.Process(target=target, args=args, daemon=True)
+    process.start()
+    return process
+
+
+async def wait_for(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+def memory_kb(pid, field):
+    """Memory statistics of a process from /proc (Linux only), e.g. VmHWM for the peak resident set size"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))] if values else float('nan')
+
+
+def request_factory(name, dataset, batch_size=4):
+    method, path, body = ENDPOINTS[name]
+    experiments = cycle(sorted(dataset.resources['experiment']))
+    groups = cycle(dataset.groups)
+
+    def make():
+        url = path.format(experiment=next(experiments))
+        if body is None:
+            return method, url, None
+        if name.endswith('-batch'):
+            return method, url, {'requests': [dict(body, sampleIds=next(groups)) for _ in range(batch_size)]}
+        return method, url, dict(body, sampleIds=next(groups))
+    return make
+
+
+async def drive(base_url, make_request, concurrency, requests, headers):
+    latencies, errors = [], 0
+
+    async def worker(session, count):
+        nonlocal errors
+        for _ in range(count):
+            method, url, body = make_request()
+            start = time.monotonic()
+            try:
+                async with session.request(method, base_url + url, json=body, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.monotonic() - start)
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+        start = time.monotonic()
+        counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+        await asyncio.gather(*[worker(session, count) for count in counts if count])
+        elapsed = time.monotonic() - start
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def run(args, dataset, base_url, service_pid):
+    headers = {} if args.compression else {'Accept-Encoding': 'identity'}
+    await wait_for(base_url + '/iloop-to-model/species')
+    results = []
+    print('{:<16}{:>6}{:>10}{:>8}{:>12}{:>12}{:>12}'.format(
+        'endpoint', 'conc', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p99 (ms)') + '{:>16}'.format('peak RSS (MB)'))
+    for name in args.endpoints:
+        make_request = request_factory(name, dataset)
+        for concurrency in args.concurrency:
+            result = await drive(base_url, make_request, concurrency, args.requests, headers)
+            peak = memory_kb(service_pid, 'VmHWM')
+            result.update(endpoint=name, concurrency=concurrency, peak_rss_mb=peak and peak / 1024)
+            results.append(result)
+            print('{endpoint:<16}{concurrency:>6}{requests:>10}{errors:>8}{throughput:>12.1f}{p50_ms:>12.1f}'
+                  '{p99_ms:>12.1f}'.format(**result) + '{:>16}'.format('{:.0f}'.format(peak / 1024) if peak else '-'))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoints', nargs='+', default=list(ENDPOINTS), choices=list(ENDPOINTS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=64, help='requests per endpoint and concurrency level')
+    parser.add_argument('--iloop-latency', type=float, default=5, help='milliseconds per iLoop request')
+    parser.add_argument('--model-latency', type=float, default=500, help='milliseconds per simulation')
+    parser.add_argument('--reactions', type=int, default=2583, help='size of the model and flux maps')
+    parser.add_argument('--experiments', type=int, default=4)
+    parser.add_argument('--groups', type=int, default=8, help='sample groups per experiment')
+    parser.add_argument('--replicates', type=int, default=3, help='samples per sample group')
+    parser.add_argument('--phases', type=int, default=4)
+    parser.add_argument('--lineage', type=int, default=10, help='depth of the strain and pool lineages')
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+                        help='ask for uncompressed responses')
+    parser.add_argument('--env', nargs='*', default=[], metavar='KEY=VALUE', help='settings of the service')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    dataset_args = dict(experiments=args.experiments, groups=args.groups, replicates=args.replicates,
+                        phases=args.phases, lineage=args.lineage)
+    dataset = Dataset(**dataset_args)
+    iloop_port, model_port, service_port = free_port(), free_port(), free_port()
+    env = {
+        'ENVIRONMENT': 'development',
+        'ILOOP_API': 'http://127.0.0.1:{}/api'.format(iloop_port),
+        'ILOOP_TOKEN': 'benchmark',
+        'MODEL_API': 'http://127.0.0.1:{}'.format(model_port),
+    }
+    env.update(item.split('=', 1) for item in args.env)
+    processes = [
+        start(serve, fake_iloop, iloop_port, dataset, args.iloop_latency / 1000),
+        start(serve, fake_model_service, model_port, args.reactions, args.model_latency / 1000),
+    ]
+    service = start(serve, service_app, service_port, env)
+    processes.append(service)
+    try:
+        results = asyncio.get_event_loop().run_until_complete(
+            run(args, dataset, 'http://127.0.0.1:{}'.format(service_port), service.pid))
+    finally:
+        for process in processes:
+            process.terminate()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': dict(vars(args), env=env), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,9 +15,11 @@
 
 """Configure the gunicorn server."""
 
+import glob
 import os
 
 _config = os.environ["ENVIRONMENT"]
+_metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
 
 bind = "0.0.0.0:7000"
 worker_class = "aiohttp.worker.GunicornWebWorker"
@@ -33,3 +35,17 @@ else:
     workers = 1
     reload = True
     loglevel = "DEBUG"
+
+
+def on_starting(server):
+    """Start with empty metrics, the files left by a previous run would be aggregated otherwise."""
+    if _metrics_dir:
+        for path in glob.glob(os.path.join(_metrics_dir, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    """Stop reporting the gauges of live values (e.g. requests in flight) of an exited worker."""
+    if _metrics_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -12,17 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import logging
 import sys
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import lru_cache, partial
 
 from potion_client import Client
 from potion_client.auth import HTTPBearerAuth
 from raven import Client as RavenClient
 from raven.conf import setup_logging
 from raven.handlers.logging import SentryHandler
+from requests.adapters import HTTPAdapter
 
 from . import settings
+from .deadline import request_scope
+from .limiter import iloop_rate
+from .metrics import observe_stage
+from .tracing import span
+
+
+if sys.version_info < (3, 7):
+    import aiocontextvars  # noqa: F401 (propagates context variables to asyncio tasks)
 
 
 logger = logging.getLogger('iloop-to-model')
@@ -36,9 +48,50 @@ handler.setLevel(logging.WARNING)
 setup_logging(handler)
 
 
+class ScopedAdapter(HTTPAdapter):
+    """Transport for iLoop requests which refuses to send them for a cancelled request, waits for iLoop no longer
+    than the time left to answer the request, and keeps to the request rate set for background work"""
+
+    def send(self, request, timeout=None, **kwargs):
+        rate = iloop_rate.get()
+        if rate is not None:
+            rate.wait()
+        scope = request_scope.get()
+        if scope is not None:
+            scope.check()
+            left = scope.remaining()
+            if left is not None and timeout is None:  # potion never sets a timeout itself
+                timeout = max(left, 0.001)
+        return super().send(request, timeout=timeout, **kwargs)
+
+
 @lru_cache(128)
 def iloop_client(api, token):
-    return Client(
+    """iLoop client for the given API and token. Blocking: building a client reads the iLoop schema, which is done
+    through the ScopedAdapter, so within the time left to the current request."""
+    client = Client(
         api,
+        fetch_schema=False,
         auth=HTTPBearerAuth(token),
     )
+    client.session.mount('http://', ScopedAdapter())
+    client.session.mount('https://', ScopedAdapter())
+    client._fetch_schema()
+    return client
+
+
+# potion_client is synchronous: every lazy attribute access may hit iLoop, so all iLoop work is done on this pool
+iloop_executor = ThreadPoolExecutor(max_workers=settings.Default.ILOOP_WORKERS, thread_name_prefix='iloop')
+
+
+async def run_iloop(function, *args, **kwargs):
+    """Run a blocking iLoop call in the iLoop thread pool so that it does not stall the event loop
+
+    :param function: callable doing the iLoop access, e.g. iloop.Sample.fetch or a function reading sample attributes
+    :return: the return value of the function
+    """
+    loop = asyncio.get_event_loop()
+    # the thread runs in the context of the caller, so that iLoop requests know which request they are made for
+    call = partial(copy_context().run, function, *args, **kwargs)
+    with observe_stage('iloop'), span('iloop', getattr(function, '__name__', type(function).__name__)):
+        return await loop.run_in_executor(iloop_executor, call)
@@ -13,54 +13,137 @@
 # limitations under the License.
 
 import asyncio
-from collections import namedtuple
-from itertools import groupby
+from collections import defaultdict, namedtuple
+from functools import partial
+from itertools import chain, groupby
+from operator import itemgetter
 
 import aiohttp_cors
 from aiohttp import web
+from venom.exceptions import Error, ErrorResponse, ServerError
 from venom.rpc import Service, Venom
-from venom.rpc.comms.aiohttp import create_app
+from venom.rpc.comms.aiohttp import AioHTTPRequestContext, create_app
 from venom.rpc.method import http
 from venom.rpc.reflect.service import ReflectService
 
-from iloop_to_model import iloop_client, logger
+from iloop_to_model import iloop_client, logger, run_iloop
+from iloop_to_model.cache import iloop_entities
+from iloop_to_model.deadline import enforces_deadline, gather_cancelling, within_deadline
+from iloop_to_model.experiment_index import experiment_index, start_experiment_index, stop_experiment_index
 from iloop_to_model.iloop_to_model import (
-    ILOOP_SPECIES_TO_TAXON, fluxes_for_phase, gather_for_phases, info_for_samples, model_for_phase,
-    model_options_for_samples, phases_for_samples, scalars_by_phases, theoretical_maximum_yield_for_phase)
-from iloop_to_model.middleware import raven_middleware
+    ILOOP_SPECIES_TO_TAXON, fetch_samples, fluxes_for_phase, gather_for_phases, info_for_samples, model_diff,
+    model_for_phase, model_options_for_samples, phases_as_completed, phases_for_samples, sample_group_message,
+    scalars_by_phases, theoretical_maximum_yield_for_phase)
+from iloop_to_model.metrics import metrics_handler, metrics_middleware
+from iloop_to_model.middleware import (
+    compression_middleware, concurrency_middleware, deadline_middleware, raven_middleware)
+from iloop_to_model.protocol import FastJSONProtocol, error_response
+from iloop_to_model.session import close_model_session, open_model_session
 from iloop_to_model.settings import Default
 from iloop_to_model.stubs import (
     CurrentOrganismsMessage, ExperimentMessage, ExperimentsMessage, ExperimentsRequestMessage, JSONValue,
-    MaximumYieldMessage, MaximumYieldsMessage, MeasurementMessage, MetaboliteMediumMessage, MetabolitePhasePlaneMessage,
-    ModelMessage, ModelRequestMessage, ModelsMessage, OrganismToTaxonMessage, PhaseMessage, PhasePlaneMessage,
-    PhasePlanesMessage, PhasesMessage, SampleInfoMessage, SampleMessage, SampleModelsMessage, SamplesInfoMessage,
-    SamplesMessage, SamplesRequestMessage)
+    MaximumYieldMessage, MaximumYieldsBatchMessage, MaximumYieldsMessage, MeasurementMessage, MetaboliteMediumMessage,
+    MetabolitePhasePlaneMessage, ModelDiffMessage, ModelMessage, ModelRequestMessage, ModelRequestsMessage,
+    ModelsBatchMessage, ModelsDiffMessage, ModelsMessage, OrganismToTaxonMessage, PhaseMessage, PhaseModelMessage,
+    PhasePlaneMessage, PhasePlanesMessage, PhasesMessage, SampleInfoMessage, SampleMessage, SampleModelsMessage,
+    SamplesInfoMessage, SamplesMessage, SamplesRequestMessage, WarmupStatusMessage)
+from iloop_to_model.tracing import tracing_middleware
+from iloop_to_model.warmup import start_warmer, stop_warmer, warmer
 
 
 NamedSample = namedtuple('NamedSample', 'pool medium feed_medium operation')
 
 
-def iloop_from_context(context):
+def iloop_credentials(context):
     headers = context.request.headers
     api, token = Default.ILOOP_API, Default.ILOOP_TOKEN
     if 'Authorization' in headers:
         token = headers['Authorization'].replace('Bearer ', '')
-    return iloop_client(api, token)
+    return api, token
 
 
-async def sample_in_phases_venom(request, iloop, function_for_phase):
-    samples = [iloop.Sample(s) for s in request.sample_ids]
+async def iloop_from_context(context):
+    """iLoop client for the credentials of the request, built in the iLoop thread pool"""
+    return await run_iloop(iloop_client, *iloop_credentials(context))
 
-    async def for_phase(s):
-        scalars = scalars_by_phases(s)
-        return await function_for_phase(s, scalars[request.phase_id])
 
-    async def for_samples(s):
-        return await gather_for_phases(s, function_for_phase)
+async def prepare_sample_group(request, iloop, samples=None, group_messages=None):
+    """Fetch what is needed to process the requested sample group: samples, scalars by phase and group message
 
+    :param request: ModelRequestMessage
+    :param iloop: iLoop client
+    :param samples: the requested ILoop samples, fetched if not given
+    :param group_messages: dict shared between requests of a batch, caching the sample group message futures; the
+        batch cancels those still running when it is done
+    :return: tuple of samples, scalars by phase (only the requested phase, if any) and the sample group message
+    """
+    if samples is None:
+        samples = await fetch_samples(iloop, request.sample_ids)
+    key = tuple(request.sample_ids)
+    if group_messages is None:
+        group_message = run_iloop(sample_group_message, samples)
+    else:
+        if key not in group_messages:
+            group_messages[key] = asyncio.ensure_future(run_iloop(sample_group_message, samples))
+        group_message = asyncio.shield(group_messages[key])
+    scalars, group_message = await gather_cancelling(
+        run_iloop(scalars_by_phases, samples, request.phase_id or None),
+        group_message,
+    )
+    return samples, scalars, group_message
+
+
+async def sample_in_phases_venom(request, iloop, function_for_phase, samples=None, group_messages=None):
+    """Call function_for_phase for the requested phase, or all phases, of the requested sample group
+
+    :param request: ModelRequestMessage
+    :param iloop: iLoop client
+    :param function_for_phase: coroutine function taking samples, scalars for a phase and the group_message keyword
+    :param samples: the requested ILoop samples, fetched if not given
+    :param group_messages: dict shared between requests of a batch, caching the sample group message futures
+    :return: dict of results by phase id
+    """
+    samples, scalars, group_message = await prepare_sample_group(request, iloop, samples, group_messages)
+    if request.phase_id:
+        return {request.phase_id: await function_for_phase(samples, scalars[request.phase_id],
+                                                           group_message=group_message)}
+    return await gather_for_phases(samples, function_for_phase, scalars, group_message)
+
+
+async def sample_in_phases_stream(request, iloop, function_for_phase):
+    """Like sample_in_phases_venom, but return an async generator of (phase id, result) pairs, each yielded as soon as
+    the phase is done. The sample group is read from iLoop before returning, so errors in doing so are raised here.
+    """
+    samples, scalars, group_message = await prepare_sample_group(request, iloop)
     if request.phase_id:
-        return {request.phase_id: await for_phase(samples)}
-    return await for_samples(samples)
+        scalars = {request.phase_id: scalars[request.phase_id]}
+    return phases_as_completed(samples, function_for_phase, scalars, group_message)
+
+
+async def batch_in_phases_venom(requests, iloop, function_for_request):
+    """Process many sample group requests together: every sample is fetched once, sample group messages are shared
+    and at most Default.BATCH_CONCURRENCY requests are processed at the same time.
+
+    :param requests: list of ModelRequestMessage
+    :param iloop: iLoop client
+    :param function_for_request: function returning the function_for_phase for a request
+    :return: list of results of sample_in_phases_venom, in the order of requests
+    """
+    sample_ids = list(dict.fromkeys(chain(*[request.sample_ids for request in requests])))
+    samples = dict(zip(sample_ids, await fetch_samples(iloop, sample_ids)))
+    group_messages = {}
+    semaphore = asyncio.Semaphore(Default.BATCH_CONCURRENCY)
+
+    async def for_request(request):
+        async with semaphore:
+            return await sample_in_phases_venom(request, iloop, function_for_request(request),
+                                                [samples[i] for i in request.sample_ids], group_messages)
+
+    try:
+        return await gather_cancelling(*[for_request(request) for request in requests])
+    finally:
+        for future in group_messages.values():
+            future.cancel()
 
 
 class SpeciesService(Service):
@@ -73,23 +156,16 @@ class SpeciesService(Service):
 
     @http.GET('./current', description='Get map of taxon mnemonic code to name for current strains')
     async def current_species(self) -> CurrentOrganismsMessage:
-        iloop = iloop_from_context(self.context)
-        return CurrentOrganismsMessage(
-            dict((ILOOP_SPECIES_TO_TAXON[o.short_code], o.name)
-                 for o in iloop.Organism.instances() if o.short_code in Default.ORGANISMS_WITH_MAPS))
+        iloop = await iloop_from_context(self.context)
 
+        def current():
+            return dict((ILOOP_SPECIES_TO_TAXON[o.short_code], o.name)
+                        for o in iloop.Organism.instances() if o.short_code in Default.ORGANISMS_WITH_MAPS)
 
-def group_id(sample):
-    """Unique identifier for the sample using its properties"""
-    return NamedSample(
-        pool=sample.strain.pool.id,
-        medium=sample.medium.id,
-        feed_medium=getattr(sample.feed_medium, 'id', 0),
-        operation=sample.operation
-    )
+        return CurrentOrganismsMessage(await run_iloop(current))
 
 
-def name_groups(grouped_samples, unique_keys, names):
+def name_groups(grouped_samples, unique_keys, names, organisms=None):
     """Generate a name for the group of samples, using the distinctive properties.
 
     Example: for samples with following property identifiers
@@ -104,6 +180,7 @@ def name_groups(grouped_samples, unique_keys, names):
     :param grouped_samples: iterables of samples
     :param unique_keys: a unique key for every group from grouped_samples
     :param names: corresponding names for ids from unique_keys
+    :param organisms: organism short code for every group, read from the strain of its first sample if not given
     :return:
     """
     result = []
@@ -120,58 +197,113 @@ def name_groups(grouped_samples, unique_keys, names):
         result.append(SampleMessage(
             id=[s.id for s in group],
             name=', '.join([names[i][j] for j in indexes]),
-            organism=group[0].strain.organism.short_code
+            organism=organisms[i] if organisms is not None else group[0].strain.organism.short_code
         ))
     return result
 
 
+def strain_sample_keys(strain, samples, operation):
+    """Resolve a strain and compute the grouping keys of its samples: pool, medium, feed medium and operation. Runs in
+    the iLoop thread pool, as resolving the strain may read it from iLoop.
+
+    :param strain: iLoop strain
+    :param samples: list of (index, sample) pairs of the samples of the strain
+    :param operation: the experiment's map of sample names to operations
+    :return: tuple of a list of (key, index, sample) triples and the organism short code of the strain
+    """
+    strain = iloop_entities.resolve(strain)
+    keys = [(NamedSample(
+        pool=strain.pool.id,
+        medium=sample.medium.id,
+        feed_medium=getattr(sample.feed_medium, 'id', 0),
+        operation=operation.get(sample.name, sample.name),
+    ), index, sample) for index, sample in samples]
+    return keys, strain.organism.short_code
+
+
+async def iloop_lookup(function, keys):
+    """Concurrently call a blocking iLoop function once for every distinct key
+
+    :param function: function taking a key
+    :param keys: iterable of hashable keys
+    :return: dict of results by key
+    """
+    keys = list(dict.fromkeys(keys))
+    return dict(zip(keys, await gather_cancelling(*[run_iloop(function, key) for key in keys])))
+
+
+async def sample_groups_for_experiment(iloop, experiment_id):
+    """Group the samples of an experiment by pool, medium, feed medium and operation. Samples are read once and
+    every distinct strain, pool and medium is fetched once, concurrently.
+
+    :param iloop: iLoop client
+    :param experiment_id: experiment identifier
+    :return: list of SampleMessage
+    """
+    experiment = iloop.Experiment(experiment_id)
+
+    def read_samples():
+        strains, samples_by_strain = {}, defaultdict(list)
+        for index, sample in enumerate(experiment.read_samples()):
+            strains[sample.strain.id] = sample.strain
+            samples_by_strain[sample.strain.id].append((index, sample))
+        return strains, samples_by_strain, experiment.attributes['operation'] or {}
+
+    strains, samples_by_strain, operation = await run_iloop(read_samples)
+    keyed_by_strain = await iloop_lookup(
+        lambda strain_id: strain_sample_keys(strains[strain_id], samples_by_strain[strain_id], operation), strains)
+    # ordered by key, then as read from iLoop
+    keyed_samples = sorted((key, index, sample, organism)
+                           for keys, organism in keyed_by_strain.values() for key, index, sample in keys)
+    grouped_samples = []
+    unique_keys = []
+    organisms = []
+    for k, g in groupby(keyed_samples, itemgetter(0)):
+        g = list(g)
+        grouped_samples.append([sample for _, _, sample, _ in g])
+        unique_keys.append(k)
+        organisms.append(g[0][3])
+    pools, media = await gather_cancelling(
+        iloop_lookup(lambda pool_id: iloop_entities.resolve(iloop.Pool(pool_id)).identifier,
+                     [key.pool for key in unique_keys]),
+        iloop_lookup(lambda medium_id: iloop_entities.resolve(iloop.Medium(medium_id)).name,
+                     [m for key in unique_keys for m in (key.medium, key.feed_medium) if m != 0]),
+    )
+    names = [(
+        pools[key.pool],
+        media[key.medium],
+        '' if key.feed_medium == 0 else media[key.feed_medium],
+        key.operation,
+    ) for key in unique_keys]
+    return name_groups(grouped_samples, unique_keys, names, organisms)
+
+
 class ExperimentsService(Service):
     class Meta:
         name = 'iloop-to-model/experiments'
 
     @http.GET('.', description='List of experiments')
     async def experiments(self) -> ExperimentsMessage:
-        iloop = iloop_from_context(self.context)
-        experiments = iloop.Experiment.instances(where=dict(type='fermentation'))
-        return ExperimentsMessage([ExperimentMessage(id=experiment.id, name=experiment.identifier)
-                                   for experiment in experiments])
+        iloop = await iloop_from_context(self.context)
+
+        def experiments():
+            return [ExperimentMessage(id=experiment.id, name=experiment.identifier)
+                    for experiment in iloop.Experiment.instances(where=dict(type='fermentation'))]
+
+        return ExperimentsMessage(await run_iloop(experiments))
 
     @http.GET('./{taxon_code}', description='List of experiments involving given species')
     async def experiments_for_species(self, request: ExperimentsRequestMessage) -> ExperimentsMessage:
-        iloop = iloop_from_context(self.context)
-        experiments = [e for e in iloop.Experiment.instances(where=dict(type='fermentation')) if
-                       request.taxon_code in {ILOOP_SPECIES_TO_TAXON[s.strain.organism.short_code] for s in
-                       e.read_samples()}]
+        iloop = await iloop_from_context(self.context)
+        experiments = await experiment_index.experiments_for_taxon(iloop, request.taxon_code)
         return ExperimentsMessage([ExperimentMessage(id=experiment.id, name=experiment.identifier)
                                    for experiment in experiments])
 
     @http.GET('./{experiment_id}/samples', description='List of samples for the given experiment')
     async def list_samples(self, request: SamplesRequestMessage) -> SamplesMessage:
-        iloop = iloop_from_context(self.context)
-        experiment = iloop.Experiment(request.experiment_id)
-        samples = list(experiment.read_samples())
-        operation = experiment.attributes['operation'] or {}
-        for s in samples:
-            s.operation = s.name
-        for k, v in operation.items():
-            for s in samples:
-                if s.name == k:
-                    s.operation = v
-        grouped_samples = []
-        unique_keys = []
-        names = []
-        data = sorted(experiment.read_samples(), key=group_id)
-        for k, g in groupby(data, group_id):
-            grouped_samples.append(list(g))
-            unique_keys.append(k)
-        for key in unique_keys:
-            names.append((
-                iloop.Pool(key.pool).identifier,
-                iloop.Medium(key.medium).name,
-                '' if key.feed_medium == 0 else iloop.Medium(key.feed_medium).name,
-                key.operation,
-            ))
-        return SamplesMessage(name_groups(grouped_samples, unique_keys, names))
+        iloop = await iloop_from_context(self.context)
+        warmer.record(*iloop_credentials(self.context), request.experiment_id)
+        return SamplesMessage(await sample_groups_for_experiment(iloop, request.experiment_id))
 
 
 def merge_duplicated_metabolites(medium):
@@ -190,14 +322,14 @@ class SamplesService(Service):
 
     @http.POST('./phases', description='Phases for the given list of samples')
     async def list_phases(self, request: ModelRequestMessage) -> PhasesMessage:
-        iloop = iloop_from_context(self.context)
-        samples = [iloop.Sample(s) for s in request.sample_ids]
+        iloop = await iloop_from_context(self.context)
+        samples = await fetch_samples(iloop, request.sample_ids)
         return PhasesMessage([PhaseMessage(**d) for d in await phases_for_samples(samples)])
 
     @http.POST('./info',
                description='Information about measurements, medium and genotype changes for the given list of samples')
     async def sample_info(self, request: ModelRequestMessage) -> SamplesInfoMessage:
-        iloop = iloop_from_context(self.context)
+        iloop = await iloop_from_context(self.context)
         result = await sample_in_phases_venom(request, iloop, info_for_samples)
         return SamplesInfoMessage(response={k: SampleInfoMessage(
             genotype_changes=v['genotype-changes'],
@@ -208,69 +340,168 @@ class SamplesService(Service):
     @http.POST('./model-options',
                description='Information about measurements, medium and genotype changes for the given list of samples')
     async def sample_model_options(self, request: ModelRequestMessage) -> SampleModelsMessage:
-        iloop = iloop_from_context(self.context)
-        sample = iloop.Sample(request.sample_ids[0])
+        iloop = await iloop_from_context(self.context)
+        sample, = await fetch_samples(iloop, request.sample_ids[:1])
         result = await model_options_for_samples(sample)
         return SampleModelsMessage(response=result)
 
 
+def maximum_yields_function(request):
+    return partial(theoretical_maximum_yield_for_phase, model_id=request.model_id or None)
+
+
+def maximum_yields_message(result):
+    return MaximumYieldsMessage(
+        response={k: MaximumYieldMessage(
+            growth_rate=v['growth-rate'],
+            metabolites={i: MetabolitePhasePlaneMessage(
+                flux=j['flux'],
+                phase_planes=PhasePlanesMessage(
+                    wild=PhasePlaneMessage(**j['phase-planes']['wild']),
+                    modified=PhasePlaneMessage(**j['phase-planes']['modified']),
+                )
+            ) for i, j in v['metabolites'].items()}
+        ) for k, v in result.items()}
+    )
+
+
+def fluxes_function(request):
+    return partial(fluxes_for_phase, method=request.method, map=request.map, model_id=request.model_id,
+                   objective=request.objective)
+
+
+def fluxes_message(result):
+    return ModelsMessage(response={k: ModelMessage(**v) for k, v in result.items()})
+
+
+def model_function(request):
+    return partial(model_for_phase, with_fluxes=request.with_fluxes, method=request.method, map=request.map,
+                   model_id=request.model_id, objective=request.objective)
+
+
+def model_phase_message(result_for_phase):
+    return ModelMessage(
+        model=JSONValue(result_for_phase['model']),
+        model_id=result_for_phase['model_id'],
+        growth_rate=result_for_phase['growth-rate'],
+        fluxes=result_for_phase.get('fluxes')
+    )
+
+
+def model_message(result):
+    return ModelsMessage(response={k: model_phase_message(v) for k, v in result.items()})
+
+
+def model_diff_message(result):
+    if not result:
+        return ModelsDiffMessage(response={})
+    base_phase_id = min(result)
+    base = result[base_phase_id]['model']
+    return ModelsDiffMessage(base_phase_id=base_phase_id, base=JSONValue(base), response={k: ModelDiffMessage(
+        changes=JSONValue(model_diff(base, v['model'])),
+        model_id=v['model_id'],
+        growth_rate=v['growth-rate'],
+        fluxes=v.get('fluxes')
+    ) for k, v in result.items()})
+
+
+def error_line(error):
+    """Last line of a stream ended by a venom error: {"error": ErrorResponse}"""
+    return b'{"error": ' + FastJSONProtocol(ErrorResponse).pack(error.format()) + b'}\n'
+
+
+@enforces_deadline(Default.STREAM_TIMEOUT)
+async def stream_sample_model(http_request):
+    """Adjusted models as newline delimited JSON, one PhaseModelMessage per line, each phase written as soon as it is
+    done. Takes the same request as /data-adjusted/model, and errors before the first phase are answered the same way.
+    A later error, or running out of STREAM_TIMEOUT seconds, ends the stream with an error line (see error_line)."""
+    try:
+        request = FastJSONProtocol(ModelRequestMessage).unpack(await http_request.read())
+        iloop = await iloop_from_context(AioHTTPRequestContext(http_request))
+        phases = await within_deadline(sample_in_phases_stream(request, iloop, model_function(request)))
+    except Error as error:
+        return error_response(error)
+    line = FastJSONProtocol(PhaseModelMessage)
+    response = web.StreamResponse()
+    response.content_type = 'application/x-ndjson'
+    await response.prepare(http_request)
+    try:
+        while True:
+            try:
+                phase_id, result = await within_deadline(phases.__anext__())
+            except StopAsyncIteration:
+                break
+            await response.write(line.pack(PhaseModelMessage(phase_id=phase_id, response=model_phase_message(result)))
+                                 + b'\n')
+    except (asyncio.CancelledError, ConnectionResetError):
+        raise  # the client is gone
+    except Error as error:
+        await response.write(error_line(error))
+    except Exception:
+        logger.exception('Streaming models failed')  # captured by Sentry too
+        await response.write(error_line(ServerError()))
+    finally:
+        await phases.aclose()
+    await response.write_eof()
+    return response
+
+
+class WarmupService(Service):
+    class Meta:
+        name = 'iloop-to-model/warmup'
+
+    @http.GET('.', description='Progress of the background cache warm-up')
+    async def warmup_status(self) -> WarmupStatusMessage:
+        return WarmupStatusMessage(**warmer.status)
+
+
 class DataAdjustedService(Service):
     class Meta:
         name = 'iloop-to-model/data-adjusted'
 
     @http.POST('./maximum-yield', description='Calculate maximum yield for given model and sample list')
     async def sample_maximum_yields(self, request: ModelRequestMessage) -> MaximumYieldsMessage:
-        iloop = iloop_from_context(self.context)
-        model_id = request.model_id or None
-        result = await sample_in_phases_venom(request, iloop,
-                                              lambda samples, scalars: theoretical_maximum_yield_for_phase(
-                                                  samples, scalars,
-                                                  model_id))
-        return MaximumYieldsMessage(
-            response={k: MaximumYieldMessage(
-                growth_rate=v['growth-rate'],
-                metabolites={i: MetabolitePhasePlaneMessage(
-                    flux=j['flux'],
-                    phase_planes=PhasePlanesMessage(
-                        wild=PhasePlaneMessage(**j['phase-planes']['wild']),
-                        modified=PhasePlaneMessage(**j['phase-planes']['modified']),
-                    )
-                ) for i, j in v['metabolites'].items()}
-            ) for k, v in result.items()}
-        )
+        iloop = await iloop_from_context(self.context)
+        return maximum_yields_message(await sample_in_phases_venom(request, iloop, maximum_yields_function(request)))
+
+    @http.POST('./maximum-yield/batch', description='Calculate maximum yield for many sample groups, the response '
+                                                    'has one entry for each request, in the same order')
+    async def batch_maximum_yields(self, request: ModelRequestsMessage) -> MaximumYieldsBatchMessage:
+        iloop = await iloop_from_context(self.context)
+        results = await batch_in_phases_venom(request.requests, iloop, maximum_yields_function)
+        return MaximumYieldsBatchMessage(response=[maximum_yields_message(result) for result in results])
 
     @http.POST('./fluxes', description='Calculate fluxes for given model, sample list, simulation method and map')
     async def sample_fluxes(self, request: ModelRequestMessage) -> ModelsMessage:
-        iloop = iloop_from_context(self.context)
-        result = await sample_in_phases_venom(
-            request, iloop,
-            lambda samples, scalars: fluxes_for_phase(
-                samples, scalars,
-                method=request.method,
-                map=request.map,
-                model_id=request.model_id,
-                objective=request.objective
-            )
-        )
-        return ModelsMessage(response={k: ModelMessage(**v) for k, v in result.items()})
+        iloop = await iloop_from_context(self.context)
+        return fluxes_message(await sample_in_phases_venom(request, iloop, fluxes_function(request)))
+
+    @http.POST('./fluxes/batch', description='Calculate fluxes for many sample groups, the response has one entry '
+                                             'for each request, in the same order')
+    async def batch_fluxes(self, request: ModelRequestsMessage) -> ModelsBatchMessage:
+        iloop = await iloop_from_context(self.context)
+        results = await batch_in_phases_venom(request.requests, iloop, fluxes_function)
+        return ModelsBatchMessage(response=[fluxes_message(result) for result in results])
 
     @http.POST('./model', description='Return adjusted models for given model, '
                                       'sample list, simulation method and map. '
                                       'Fluxes information can be added')
     async def sample_model(self, request: ModelRequestMessage) -> ModelsMessage:
-        iloop = iloop_from_context(self.context)
-        result = await sample_in_phases_venom(request, iloop,
-                                              lambda samples, scalars: model_for_phase(
-                                                  samples, scalars,
-                                                  with_fluxes=request.with_fluxes,
-                                                  method=request.method, map=request.map,
-                                                  model_id=request.model_id, objective=request.objective))
-        return ModelsMessage(response={k: ModelMessage(
-            model=JSONValue(v['model']),
-            model_id=v['model_id'],
-            growth_rate=v['growth-rate'],
-            fluxes=v.get('fluxes')
-        ) for k, v in result.items()})
+        iloop = await iloop_from_context(self.context)
+        return model_message(await sample_in_phases_venom(request, iloop, model_function(request)))
+
+    @http.POST('./model/diff', description='Return adjusted models like /model, but with the model of the first '
+                                           'phase given once as base and only the changes to it for every phase')
+    async def sample_model_diff(self, request: ModelRequestMessage) -> ModelsDiffMessage:
+        iloop = await iloop_from_context(self.context)
+        return model_diff_message(await sample_in_phases_venom(request, iloop, model_function(request)))
+
+    @http.POST('./model/batch', description='Return adjusted models for many sample groups, the response has one '
+                                            'entry for each request, in the same order')
+    async def batch_model(self, request: ModelRequestsMessage) -> ModelsBatchMessage:
+        iloop = await iloop_from_context(self.context)
+        results = await batch_in_phases_venom(request.requests, iloop, model_function)
+        return ModelsBatchMessage(response=[model_message(result) for result in results])
 
 
 def get_app():
@@ -279,8 +510,19 @@ def get_app():
     venom.add(ExperimentsService)
     venom.add(SamplesService)
     venom.add(DataAdjustedService)
+    venom.add(WarmupService)
     venom.add(ReflectService)
-    app = create_app(venom, web.Application(middlewares=[raven_middleware]))
+    middlewares = [raven_middleware, metrics_middleware, tracing_middleware, deadline_middleware,
+                   compression_middleware, concurrency_middleware]
+    app = create_app(venom, web.Application(middlewares=middlewares), protocol_factory=FastJSONProtocol)
+    app.router.add_post('/iloop-to-model/data-adjusted/model/stream', stream_sample_model)
+    app.router.add_get('/metrics', metrics_handler)
+    app.on_startup.append(open_model_session)
+    app.on_cleanup.append(close_model_session)
+    app.on_startup.append(start_experiment_index)
+    app.on_cleanup.append(stop_experiment_index)
+    app.on_startup.append(start_warmer)
+    app.on_cleanup.append(stop_warmer)
     # Configure default CORS settings.
     cors = aiohttp_cors.setup(app, defaults={
         "*": aiohttp_cors.ResourceOptions(
@@ -0,0 +1,318 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextvars import copy_context
+from functools import partial
+
+import redis
+from potion_client.resource import Resource
+
+from iloop_to_model import logger
+from iloop_to_model.deadline import SharedScope, request_scope, within_deadline
+from iloop_to_model.limiter import request_limiter
+from iloop_to_model.metrics import watch_cache, watch_single_flight
+from iloop_to_model.settings import Default
+from iloop_to_model.tracing import current_trace
+
+
+def cache_key(*parts):
+    """Canonical hash of JSON serializable parts, independent of dictionary ordering
+
+    :return: hex digest string
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+class TTLCache(object):
+    """In-process cache with time-to-live expiry and least recently used eviction. Besides the number of entries, the
+    total size of the entries can be bounded, with sizes given by the caller when setting them."""
+
+    def __init__(self, maxsize, ttl, maxbytes=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value, size = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < time.monotonic():
+            del self._data[key]
+            self.bytes -= size
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, size=0):
+        """
+        :param size: approximate size of the value in bytes, only counted if maxbytes is set
+        """
+        if self.maxsize <= 0 or (self.maxbytes and size > self.maxbytes):
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        self._data[key] = (time.monotonic() + self.ttl, value, size)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (self.maxbytes and self.bytes > self.maxbytes):
+            self.bytes -= self._data.popitem(last=False)[1][2]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+
+# decoded JSON takes about four times its encoded size as Python objects (msgpack, being denser, somewhat more)
+PYTHON_BYTES_PER_JSON_BYTE = 4
+
+
+class ResultCache(object):
+    """Two tier cache for JSON serializable results: in-process first, then Redis (if configured) shared by all
+    workers. Cached values are shared between callers and must not be mutated. The in-process tier is bounded by the
+    approximate memory taken by the results if its maxbytes is set, as full models take megabytes each."""
+
+    def __init__(self, memory, redis_client=None, prefix='iloop-to-model:'):
+        self.memory = memory
+        self.redis = redis_client
+        self.prefix = prefix
+
+    async def _redis(self, function, *args):
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, function, *args)
+        except redis.RedisError as error:
+            logger.warning('Redis cache unavailable: {}'.format(error))
+            return None
+
+    async def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.redis is not None:
+            data = await self._redis(self.redis.get, self.prefix + key)
+            if data is not None:
+                value = json.loads(data)
+                self.memory.set(key, value, len(data) * PYTHON_BYTES_PER_JSON_BYTE)
+        return value
+
+    async def set(self, key, value, size=0):
+        """Cache a result
+
+        :param key: str
+        :param value: JSON serializable result
+        :param size: bytes the result was received in, e.g. the length of the model service response, from which the
+            memory it takes is estimated
+        """
+        self.memory.set(key, value, size * PYTHON_BYTES_PER_JSON_BYTE)
+        if self.redis is not None:
+            # encoding a model takes tens of milliseconds, too long for the event loop
+            data = await asyncio.get_event_loop().run_in_executor(None, json.dumps, value)
+            await self._redis(self.redis.setex, self.prefix + key, int(self.memory.ttl), data)
+
+
+_shared_scopes = weakref.WeakKeyDictionary()
+
+
+def _start_detached(function, *args, **kwargs):
+    scope = SharedScope()
+    request_scope.set(scope)
+    request_limiter.set(None)
+    current_trace.set(None)
+    future = asyncio.ensure_future(function(*args, **kwargs))
+    _shared_scopes[future] = scope
+    future.add_done_callback(lambda future: scope.cancel())
+    return future
+
+
+def start_shared(function, *args, **kwargs):
+    """Start function(*args, **kwargs) as a task to be shared between requests (see wait_shared). The task does not
+    belong to the request starting it: its deadline is the latest of the callers waiting for it, and it runs without
+    the model service concurrency limit and trace of the request, which the callers apply while waiting instead.
+
+    :param function: coroutine function
+    :return: asyncio task
+    """
+    return copy_context().run(_start_detached, function, *args, **kwargs)
+
+
+async def wait_shared(future, waiters):
+    """Await a future shared between callers, e.g. a call in flight joined by several requests, within the deadline of
+    the caller. A caller leaving, by being cancelled or running out of time, leaves the future running for the others,
+    unless it was the last caller waiting for it: then the future is cancelled as well, as nobody needs its result any
+    more.
+
+    :param future: asyncio future or task, see start_shared
+    :param waiters: dict counting the callers waiting for each future, shared by all callers of the future
+    :return: the result of the future
+    :raises DeadlineExceeded: when the caller runs out of time first
+    """
+    waiters[future] = waiters.get(future, 0) + 1
+    shared_scope = _shared_scopes.get(future)
+    scope = request_scope.get()
+    if shared_scope is not None:
+        shared_scope.waiting.append(scope)
+    try:
+        return await within_deadline(asyncio.shield(future))
+    finally:
+        if shared_scope is not None:
+            shared_scope.waiting.remove(scope)
+        count = waiters.pop(future) - 1
+        if count:
+            waiters[future] = count
+        elif not future.done():
+            future.cancel()
+
+
+class SingleFlight(object):
+    """Share one in-flight call between concurrent callers asking for the same key. `calls` counts all calls,
+    `coalesced` those that were served by joining a call already in flight. A call is cancelled when all its callers
+    have been cancelled."""
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._pending = {}
+        self._waiters = {}
+
+    def _done(self, key, future):
+        if self._pending.get(key) is future:
+            del self._pending[key]
+        if not future.cancelled():
+            future.exception()  # retrieved, so abandoned calls do not log 'exception was never retrieved'
+
+    async def do(self, key, function, *args, **kwargs):
+        """Await function(*args, **kwargs), or the already running call for the same key
+
+        :param key: hashable identifying the call, e.g. from cache_key
+        :param function: coroutine function
+        :return: the result of the call
+        """
+        self.calls += 1
+        future = self._pending.get(key)
+        if future is None:
+            future = start_shared(function, *args, **kwargs)
+            self._pending[key] = future
+            future.add_done_callback(partial(self._done, key))
+        else:
+            self.coalesced += 1
+            logger.debug('Joined in-flight call {}'.format(key))
+        return await wait_shared(future, self._waiters)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+def _load(entity):
+    entity._status = None  # potion keeps properties once read, make sure they are read again
+    len(entity)  # reading the size of a potion resource loads its properties
+    return entity
+
+
+class EntityCache(object):
+    """Cache of resolved iLoop entities by type and id, scoped by the iLoop API and token they were read with so that
+    entities are never shared between users. Thread safe, as it is used from the iLoop thread pool.
+
+    Objects that are not potion resources (e.g. None, or test doubles) are passed through uncached."""
+
+    def __init__(self, maxsize, ttl):
+        self.cache = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    @property
+    def hits(self):
+        return self.cache.hits
+
+    @property
+    def misses(self):
+        return self.cache.misses
+
+    @staticmethod
+    def key(entity, *parts):
+        client = entity._client
+        return (client._api_root_url, client.session.auth.token, type(entity).__name__, entity.id) + parts
+
+    def resolve(self, entity):
+        """Get the resolved entity, the cached instance if the same entity was read with the same token before
+
+        :param entity: potion resource, possibly an unresolved reference
+        :return: potion resource with its properties loaded
+        """
+        if not isinstance(entity, Resource):
+            return entity
+        return self.derived(entity, None, _load)
+
+    def peek(self, entity, name):
+        """Get the cached value stored for the entity under name, None if missing or not a potion resource"""
+        if not isinstance(entity, Resource):
+            return None
+        with self._lock:
+            return self.cache.get(self.key(entity, name))
+
+    def store(self, entity, name, value):
+        if isinstance(entity, Resource):
+            with self._lock:
+                self.cache.set(self.key(entity, name), value)
+
+    def derived(self, entity, name, function):
+        """Get the cached result of function(entity), e.g. the contents of a medium
+
+        :param entity: potion resource
+        :param name: str, name of the derived value, unique for the entity type
+        :param function: function taking the entity, doing the iLoop access
+        :return: result of function
+        """
+        if not isinstance(entity, Resource):
+            return function(entity)
+        key = self.key(entity, name)
+        with self._lock:
+            value = self.cache.get(key)
+        if value is None:
+            value = function(entity)
+            with self._lock:
+                self.cache.set(key, value)
+        return value
+
+
+def redis_client():
+    if not Default.REDIS_URL:
+        return None
+    return redis.StrictRedis.from_url(Default.REDIS_URL, socket_timeout=1)
+
+
+model_results = ResultCache(TTLCache(Default.MODEL_CACHE_SIZE, Default.MODEL_CACHE_TTL, Default.MODEL_CACHE_BYTES),
+                            redis_client(), prefix='iloop-to-model:model:')
+model_calls = SingleFlight()
+iloop_entities = EntityCache(Default.ENTITY_CACHE_SIZE, Default.ENTITY_CACHE_TTL)
+watch_cache('model_results', model_results.memory)
+watch_single_flight('model_calls', model_calls)
+watch_cache('iloop_entities', iloop_entities)
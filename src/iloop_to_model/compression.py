@@ -0,0 +1,84 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import gzip
+
+import brotli
+import zstandard
+
+from .settings import Default
+
+
+CODINGS = {
+    'zstd': lambda body: zstandard.ZstdCompressor(level=3).compress(body),
+    'br': lambda body: brotli.compress(body, quality=4),
+    'gzip': lambda body: gzip.compress(body, compresslevel=6),
+}
+
+
+def accepted_codings(accept_encoding):
+    """Parse an Accept-Encoding header
+
+    :param accept_encoding: header value, e.g. 'gzip, br;q=0.8'
+    :return: dict of quality (between 0 and 1) by lower case content coding
+    """
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def negotiate_coding(accept_encoding, codings=None):
+    """Choose the content coding for a response: the one with the highest quality for the client, ties are broken by
+    the order of codings
+
+    :param accept_encoding: Accept-Encoding header value
+    :param codings: supported codings in order of preference, Default.COMPRESSION_CODINGS if not given
+    :return: the chosen coding or None if the response should not be compressed
+    """
+    if codings is None:
+        codings = Default.COMPRESSION_CODINGS
+    accepted = accepted_codings(accept_encoding)
+    best, best_quality = None, 0.0
+    for coding in codings:
+        quality = accepted.get(coding, accepted.get('*', 0.0))
+        if coding in CODINGS and quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+async def compress(body, coding):
+    """Compress body with the given content coding, in the default executor for bodies larger than
+    COMPRESSION_EXECUTOR_SIZE
+
+    :param body: bytes
+    :param coding: one of CODINGS
+    :return: compressed bytes
+    """
+    if len(body) < Default.COMPRESSION_EXECUTOR_SIZE:
+        return CODINGS[coding](body)
+    return await asyncio.get_event_loop().run_in_executor(None, CODINGS[coding], body)
@@ -0,0 +1,149 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deadline and cancellation of the work done for a request. The scope of a request starts when it arrives and is
+cancelled when it has been answered, has run out of time or the client has disconnected. Calls to other services take
+their timeouts from what is left of the time budget, and iLoop calls still running in the thread pool for a cancelled
+request stop at their next request to iLoop."""
+
+import asyncio
+import time
+from contextvars import ContextVar
+
+from venom.exceptions import Error
+
+
+class DeadlineExceeded(Error):
+    http_status = 504
+    description = 'Request deadline exceeded'
+
+
+class RequestCancelled(Exception):
+    """Raised in work done for a request that has been answered, has timed out or was abandoned by the client"""
+
+
+class RequestScope(object):
+    """Deadline and cancellation state of a request, shared by all tasks and iLoop threads working on it"""
+
+    def __init__(self, timeout=None):
+        """
+        :param timeout: seconds from now until the deadline, or a false value for no deadline
+        """
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.cancelled = False
+
+    def remaining(self):
+        """Seconds left until the deadline, None if there is no deadline"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        """Raise if no more work should be done for the request
+
+        :raises RequestCancelled: when the scope has been cancelled
+        :raises DeadlineExceeded: when the deadline has passed
+        """
+        if self.cancelled:
+            raise RequestCancelled()
+        if self.expired:
+            raise DeadlineExceeded()
+
+
+class SharedScope(RequestScope):
+    """Scope of work shared between requests (see cache.start_shared): its deadline is the latest deadline of the
+    scopes of the callers waiting for it, none if one of them has none"""
+
+    def __init__(self):
+        self.waiting = []
+        self.cancelled = False
+
+    @property
+    def deadline(self):
+        deadlines = [scope.deadline if scope is not None else None for scope in list(self.waiting)]
+        if not deadlines or None in deadlines:
+            return None
+        return max(deadlines)
+
+
+request_scope = ContextVar('request_scope', default=None)
+
+
+def remaining():
+    """Seconds left until the deadline of the current request, None if there is no deadline"""
+    scope = request_scope.get()
+    if scope is None:
+        return None
+    return scope.remaining()
+
+
+def check_scope():
+    """Raise if the current request has been cancelled or has run out of time, see RequestScope.check"""
+    scope = request_scope.get()
+    if scope is not None:
+        scope.check()
+
+
+async def within_deadline(awaitable):
+    """Await within the time left to the current request. When the time runs out the awaitable is cancelled, and has
+    finished cancelling (e.g. run the finally clauses of an async generator) when DeadlineExceeded is raised.
+
+    :raises DeadlineExceeded: when the time runs out first
+    """
+    future = asyncio.ensure_future(awaitable)
+    left = remaining()
+    if left is None:
+        return await future
+    try:
+        done, _ = await asyncio.wait([future], timeout=max(left, 0))
+    except asyncio.CancelledError:
+        future.cancel()
+        await asyncio.wait([future])
+        raise
+    if not done:
+        future.cancel()
+        await asyncio.wait([future])
+        raise DeadlineExceeded()
+    return future.result()
+
+
+def enforces_deadline(timeout):
+    """Decorator for an aiohttp handler which enforces the deadline of its requests itself, e.g. to end a streamed
+    response with an error, and has a budget of `timeout` seconds instead of REQUEST_TIMEOUT"""
+    def decorator(handler):
+        handler.request_timeout = timeout
+        handler.enforces_deadline = True
+        return handler
+    return decorator
+
+
+async def gather_cancelling(*coros_or_futures):
+    """Like asyncio.gather, but when one of the awaitables fails the others are cancelled instead of left running
+
+    :return: list of results, in the order of the awaitables
+    """
+    futures = [asyncio.ensure_future(f) for f in coros_or_futures]
+    try:
+        return await asyncio.gather(*futures)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
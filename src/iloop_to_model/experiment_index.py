@@ -0,0 +1,105 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+from iloop_to_model import iloop_client, logger, run_iloop
+from iloop_to_model.deadline import gather_cancelling
+from iloop_to_model.iloop_to_model import ILOOP_SPECIES_TO_TAXON
+from iloop_to_model.settings import Default
+
+
+def fermentation_experiments(iloop):
+    return list(iloop.Experiment.instances(where=dict(type='fermentation')))
+
+
+def experiment_taxa(experiment):
+    """Taxon codes of the organisms of all samples of an experiment"""
+    return {ILOOP_SPECIES_TO_TAXON.get(s.strain.organism.short_code) for s in experiment.read_samples()}
+
+
+class ExperimentIndex(object):
+    """Index of the taxon codes used in each fermentation experiment.
+
+    Only experiment identifiers and taxon codes are kept; which experiments a user may see is still decided by listing
+    the experiments with the user's own iLoop client. Experiments that are not indexed yet, or whose entry expired,
+    are scanned when requested; a background task rescans entries before they expire.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._taxa = {}
+
+    def is_current(self, experiment_id, margin=0):
+        entry = self._taxa.get(experiment_id)
+        return entry is not None and entry[0] > time.monotonic() + margin
+
+    async def scan(self, experiment):
+        """Index the taxon codes of an experiment"""
+        taxa = await run_iloop(experiment_taxa, experiment)
+        self._taxa[experiment.id] = (time.monotonic() + self.ttl, taxa)
+
+    async def update(self, experiments, margin=0):
+        """Scan the experiments which are not indexed or expire within margin seconds. Each experiment is indexed as
+        soon as its scan is done, so the scans finished before an update fails or is cancelled (e.g. by the deadline
+        of the request) are kept.
+
+        :param experiments: list of ILoop experiment objects
+        :param margin: seconds
+        :return: number of scanned experiments
+        """
+        stale = [e for e in experiments if not self.is_current(e.id, margin)]
+        await gather_cancelling(*[self.scan(e) for e in stale])
+        return len(stale)
+
+    async def experiments_for_taxon(self, iloop, taxon_code):
+        """Fermentation experiments, visible with the given client, involving the given species
+
+        :param iloop: iLoop client
+        :param taxon_code: species five-letter mnemonic, e.g. ECOLX
+        :return: list of ILoop experiment objects
+        """
+        experiments = await run_iloop(fermentation_experiments, iloop)
+        await self.update(experiments)
+        return [e for e in experiments if taxon_code in self._taxa[e.id][1]]
+
+    async def refresh_periodically(self, api, token, interval):
+        while True:
+            try:
+                iloop = await run_iloop(iloop_client, api, token)
+                scanned = await self.update(await run_iloop(fermentation_experiments, iloop), margin=interval)
+                logger.info('Experiment index refreshed, {} experiments scanned'.format(scanned))
+            except Exception as error:
+                logger.warning('Experiment index refresh failed: {}'.format(error))
+            await asyncio.sleep(interval)
+
+    def __len__(self):
+        return len(self._taxa)
+
+
+experiment_index = ExperimentIndex(Default.EXPERIMENT_INDEX_TTL)
+
+
+async def start_experiment_index(app):
+    """Keep the experiment index up to date in the background, if the service has its own iLoop token"""
+    if Default.ILOOP_TOKEN:
+        app['experiment_index'] = asyncio.ensure_future(experiment_index.refresh_periodically(
+            Default.ILOOP_API, Default.ILOOP_TOKEN, Default.EXPERIMENT_INDEX_INTERVAL))
+
+
+async def stop_experiment_index(app):
+    task = app.get('experiment_index')
+    if task is not None:
+        task.cancel()
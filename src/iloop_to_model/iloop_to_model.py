@@ -15,30 +15,56 @@
 import asyncio
 import json
 from collections import defaultdict
-from copy import deepcopy
 from itertools import chain
 
-import aiohttp
+import msgpack
 
-from iloop_to_model import logger
+from iloop_to_model import logger, run_iloop
+from iloop_to_model.cache import (
+    TTLCache, cache_key, iloop_entities, model_calls, model_results, start_shared, wait_shared)
+from iloop_to_model.deadline import gather_cancelling
+from iloop_to_model.limiter import request_call_slot, worker_limiter
+from iloop_to_model.metrics import observe_model_call, timed_stage, watch_cache
 from iloop_to_model.settings import Default
+from iloop_to_model.tracing import span, traced
+from iloop_to_model.upstream import call_model_service
+
+
+def lineage_with_genotypes(entity, parent_attribute):
+    """Get the ancestors of a strain or pool followed by the entity itself, and their genotype changes.
+    Memoized per entity: the walk up the parents stops at the first ancestor with a known lineage, and the result for
+    every entity on the way is built from its parent's result.
+
+    :param entity: iLoop strain or pool object, or None
+    :param parent_attribute: 'parent_strain' or 'parent_pool'
+    :return: tuple of (tuple of entities, oldest first; tuple of their non-empty genotypes)
+    """
+    name = 'lineage-' + parent_attribute
+    unresolved = []
+    lineage, genotypes = (), ()
+    while entity is not None:
+        entity = iloop_entities.resolve(entity)
+        cached = iloop_entities.peek(entity, name)
+        if cached is not None:
+            lineage, genotypes = cached
+            break
+        unresolved.append(entity)
+        entity = getattr(entity, parent_attribute)
+    for entity in reversed(unresolved):
+        lineage += (entity,)
+        if entity.genotype:
+            genotypes += (entity.genotype,)
+        iloop_entities.store(entity, name, (lineage, genotypes))
+    return lineage, genotypes
 
 
 def pool_lineage(pool):
-    lineage = [pool]
-    while pool.parent_pool is not None:
-        pool = pool.parent_pool
-        lineage.insert(0, pool)
-    return lineage
+    return list(lineage_with_genotypes(pool, 'parent_pool')[0])
 
 
 def strain_lineage(strain):
-    lineage = [strain]
-    pool_lineage_for_strain = pool_lineage(strain.pool)
-    while strain.parent_strain is not None:
-        strain = strain.parent_strain
-        lineage.insert(0, strain)
-    return pool_lineage_for_strain + lineage
+    strain = iloop_entities.resolve(strain)
+    return pool_lineage(strain.pool) + list(lineage_with_genotypes(strain, 'parent_strain')[0])
 
 
 def extract_genotype_changes(strain):
@@ -46,7 +72,9 @@ def extract_genotype_changes(strain):
     :param strain: iLoop strain object
     :return: list of strings
     """
-    return list(strain.genotype for strain in strain_lineage(strain) if strain.genotype)
+    strain = iloop_entities.resolve(strain)
+    return list(lineage_with_genotypes(strain.pool, 'parent_pool')[1] +
+                lineage_with_genotypes(strain, 'parent_strain')[1])
 
 
 def extract_medium(medium):
@@ -64,7 +92,7 @@ def extract_medium(medium):
             'id': 'chebi:' + str(compound['compound'].chebi_id),
             'name': compound['compound'].chebi_name,
             'concentration': compound['concentration']
-        } for compound in medium.read_contents()]
+        } for compound in iloop_entities.derived(medium, 'contents', lambda m: m.read_contents())]
 
 
 def compound_ids_str(compounds):
@@ -88,33 +116,64 @@ def scalar_test_key(scalar):
     return '{}_{}_{}_{}'.format(div_key(test['denominator']), div_key(test['numerator']), test['rate'], test['type'])
 
 
-def scalars_by_phases(samples):
+XREF_TYPES = ('protein', 'reaction')
+
+
+@timed_stage('scalars')
+def scalars_by_phases(samples, phase_id=None):
     """Get scalars grouped by phases among samples
 
     :param samples: list of ILoop sample objects that together make up a valid sample group (replicates)
+    :param phase_id: if given, only scalars for this phase are grouped, the rest is skipped without being inspected
     :return: a dictionary with phase identifiers as keys, and as values, dictionaries grouping all scalars from the
     same test across the different samples.
     """
     phases = defaultdict(lambda: defaultdict(list))
     for s in samples:
         for scalar in s.read_scalars():
+            if phase_id is not None and scalar['phase'].id != phase_id:
+                continue
             scalar['type'] = 'compound'
             phases[scalar['phase'].id][scalar_test_key(scalar)].append(scalar)
         if hasattr(s, 'read_xref_measurements'):
-            for subject_type in {'protein', 'reaction'}:
+            for subject_type in XREF_TYPES:
                 for xref in s.read_xref_measurements(type=subject_type):
+                    if phase_id is not None and xref['phase'].id != phase_id:
+                        continue
                     xref['type'] = subject_type
                     phases[xref['phase'].id]['{}_{}'.format(subject_type, xref['accession'])].append(xref)
     return phases
 
 
+def phases_in_samples(samples):
+    """Get the phases the samples have measurements for, without grouping the measurements or resolving the measured
+    compounds
+
+    :param samples: list of ILoop sample objects
+    :return: a dictionary with phase identifiers as keys and ILoop phase objects as values, in order of appearance
+    """
+    phases = {}
+    for s in samples:
+        for scalar in s.read_scalars():
+            phases.setdefault(scalar['phase'].id, scalar['phase'])
+        if hasattr(s, 'read_xref_measurements'):
+            for subject_type in XREF_TYPES:
+                for xref in s.read_xref_measurements(type=subject_type):
+                    phases.setdefault(xref['phase'].id, xref['phase'])
+    return phases
+
+
 def phase_name(phase):
     return '{} ({} - {} hours)'.format(phase.title, phase.start, phase.end)
 
 
+def list_phases(samples):
+    return [dict(id=k, name=phase_name(iloop_entities.resolve(phase)))
+            for k, phase in phases_in_samples(samples).items()]
+
+
 async def phases_for_samples(samples):
-    scalars = scalars_by_phases(samples)
-    return [dict(id=k, name=phase_name(v[list(v)[0]][0]['phase'])) for k, v in scalars.items()]
+    return await run_iloop(list_phases, samples)
 
 
 # TODO: make use of other types of scalars (yield, carbon yield, concentration, carbon balance, electron balance)
@@ -183,12 +242,35 @@ GROWTH_RATE = 'growth-rate'
 FLUXES = 'fluxes'
 TMY = 'tmy'
 OBJECTIVES = 'theoretical-objectives'
+MODEL_LISTS = ('reactions', 'metabolites', 'genes', 'compartments')
 
 
 def sample_model_id(sample):
     return Default.ORGANISM_TO_MODEL[sample.strain.organism.short_code]
 
 
+def load_sample(iloop, sample_id):
+    """Fetch an ILoop sample, resolving the sample and its strain so later attribute access does not block
+
+    :param iloop: iLoop client
+    :param sample_id: sample identifier
+    :return: ILoop sample object
+    """
+    sample = iloop.Sample(sample_id)
+    sample.strain.organism.short_code
+    return sample
+
+
+async def fetch_samples(iloop, sample_ids):
+    """Fetch ILoop samples concurrently in the iLoop thread pool
+
+    :param iloop: iLoop client
+    :param sample_ids: list of sample identifiers
+    :return: list of ILoop sample objects, in the order of sample_ids
+    """
+    return list(await gather_cancelling(*[run_iloop(load_sample, iloop, sample_id) for sample_id in sample_ids]))
+
+
 # TODO: clear definition of how to add oxygen to experimental conditions
 def is_aerobic(sample):
     return 'oxygen' in sample.experiment.attributes.get('conditions', {}).get('gas', '')
@@ -198,13 +280,11 @@ def add_dioxygen_to_medium(medium):
     medium.append({'id': 'chebi:10745', 'name': 'dioxygen'})
 
 
-def message_for_adjust(samples, scalars=None, objective=None):
-    """Extract information about genotype changes, medium definitions and measurements if scalars are given
-    If no phase is given, do not add measurements.
+def sample_group_message(samples):
+    """Extract the phase independent part of the adjust message: genotype changes and medium definitions.
+    Shared by the messages for all phases of the sample group, so it must not be modified.
 
     :param samples: list of ILoop sample object that make up a group of replicates, of same genotype, same medium.
-    :param scalars: scalars for particular phase
-    :param objective: str, objective reaction ID to be set to the model
     :return: dict
     """
     sample = samples[0]
@@ -215,18 +295,95 @@ def message_for_adjust(samples, scalars=None, objective=None):
     if is_aerobic(sample):
         add_dioxygen_to_medium(medium)
     logger.info('Medium for sample {} are ready'.format(sample_names))
-    measurements = extract_measurements_for_phase(scalars) if scalars else []
-    logger.info('Measurements for sample {} are ready'.format(sample_names))
-    message = {
+    return AdjustMessage({
         GENOTYPE_CHANGES: genotype_changes,
         MEDIUM: medium,
-        MEASUREMENTS: measurements,
-    }
+    })
+
+
+class AdjustMessage(dict):
+    """Adjust message for the model service. It is serialized at most once, however many model service calls are made
+    with it, so it must not be modified once used. A message extending a base message (e.g. the sample group message
+    for a phase message) reuses the serialization of the base message."""
+    __slots__ = ('base', '_fragment', '_digest')
+
+    def __init__(self, message=(), base=None):
+        super().__init__(message)
+        self.base = base
+        self._fragment = None
+        self._digest = None
+
+    def _extends_base(self):
+        return self.base is not None and all(self[key] is value for key, value in self.base.items())
+
+    def _own_items(self):
+        return {key: value for key, value in self.items() if key not in self.base}
+
+    def fragment(self):
+        """The JSON serialized message without the enclosing braces"""
+        if self._fragment is None:
+            if self._extends_base():
+                own = json.dumps(self._own_items())[1:-1]
+                self._fragment = ', '.join(part for part in (self.base.fragment(), own) if part)
+            else:
+                self._fragment = json.dumps(self)[1:-1]
+        return self._fragment
+
+    def digest(self):
+        """Canonical hash of the message, see cache_key. The hash of a message extending a base message is made from the
+        hash of the base message, so it differs from that of an equal message without a base."""
+        if self._digest is None:
+            if self._extends_base():
+                self._digest = cache_key(self.base.digest(), self._own_items())
+            else:
+                self._digest = cache_key(self)
+        return self._digest
+
+    def with_return(self, return_message):
+        """The JSON serialized message together with the return message
+
+        :param return_message: dict
+        :return: str
+        """
+        if self.keys() & return_message.keys():
+            return json.dumps(dict(self, **return_message))
+        parts = (self.fragment(), json.dumps(return_message)[1:-1])
+        return '{' + ', '.join(part for part in parts if part) + '}'
+
+
+def phase_message(group_message, measurements, objective=None):
+    """Combine the sample group message with the measurements for a phase
+
+    :param group_message: dict, result of sample_group_message
+    :param measurements: list, result of extract_measurements_for_phase
+    :param objective: str, objective reaction ID to be set to the model
+    :return: dict
+    """
+    message = AdjustMessage(group_message, base=group_message if isinstance(group_message, AdjustMessage) else None)
+    message[MEASUREMENTS] = measurements
     if objective:
         message[OBJECTIVE] = objective
     return message
 
 
+@timed_stage('adjust_message')
+def message_for_adjust(samples, scalars=None, objective=None, group_message=None):
+    """Extract information about genotype changes, medium definitions and measurements if scalars are given
+    If no phase is given, do not add measurements.
+
+    :param samples: list of ILoop sample object that make up a group of replicates, of same genotype, same medium.
+    :param scalars: scalars for particular phase
+    :param objective: str, objective reaction ID to be set to the model
+    :param group_message: result of sample_group_message for samples, extracted if not given
+    :return: dict
+    """
+    if group_message is None:
+        group_message = sample_group_message(samples)
+    measurements = extract_measurements_for_phase(scalars) if scalars else []
+    logger.info('Measurements for sample {} are ready'.format(','.join(s.name for s in samples)))
+    return phase_message(group_message, measurements, objective)
+
+
 ILOOP_SPECIES_TO_TAXON = {
     'ECO': 'ECOLX',
     'SCE': 'YEAST',
@@ -241,46 +398,93 @@ async def model_options_for_samples(sample):
 
     :param sample: ILoop sample object
     """
-    species = ILOOP_SPECIES_TO_TAXON[sample.strain.organism.short_code]
+    short_code = await run_iloop(lambda: sample.strain.organism.short_code)
+    species = ILOOP_SPECIES_TO_TAXON[short_code]
     url = '{}/model-options/{}'.format(Default.MODEL_API, species)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as r:
-            assert r.status == 200, f'response status {r.status} from model service'
-            return await r.json()
+    return await call_model_service('GET', url, read_model_response, headers=model_accept_headers())
+
+
+MSGPACK_CONTENT_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def model_accept_headers():
+    """Accept header for model service requests, preferring msgpack if MODEL_MSGPACK is set"""
+    if Default.MODEL_MSGPACK:
+        return {'Accept': 'application/msgpack, application/json;q=0.9'}
+    return {'Accept': 'application/json'}
+
 
+async def read_sized_model_response(r):
+    """Decode a model service response according to its content type, msgpack or JSON
 
-async def make_request(model_id, message):
-    """Make asynchronous call to model service
+    :param r: aiohttp client response
+    :return: tuple of decoded body and length of the body in bytes
+    """
+    data = await r.read()
+    if r.content_type in MSGPACK_CONTENT_TYPES:
+        return msgpack.unpackb(data, raw=False), len(data)
+    return await r.json(), len(data)
+
+
+async def read_model_response(r):
+    """Decode a model service response according to its content type, msgpack or JSON
+
+    :param r: aiohttp client response
+    :return: decoded body
+    """
+    return (await read_sized_model_response(r))[0]
+
+
+async def make_request(model_id, message, read_response=read_model_response):
+    """Make asynchronous call to model service. Simulations do not change the model service, so failed calls are
+    retried.
 
     :param model_id: str
-    :param message: dict
+    :param message: dict, or the message already serialized to JSON
+    :param read_response: coroutine function reading the aiohttp client response, e.g. read_sized_model_response
     :return: response for the service as dict
     """
-    async with aiohttp.ClientSession(headers={'Content-Type': 'application/json'}) as session:
-        async with session.post(
-                '{}/models/{}'.format(Default.MODEL_API, model_id),
-                data=json.dumps({'message': message})
-        ) as r:
-            assert r.status == 200, f'response status {r.status} from model service'
-            return await r.json()
+    if not isinstance(message, str):
+        message = json.dumps(message)
+    async with worker_limiter:
+        with observe_model_call(model_id):
+            return await call_model_service(
+                'POST', '{}/models/{}'.format(Default.MODEL_API, model_id), read_response,
+                data='{"message": ' + message + '}',
+                headers={'Content-Type': 'application/json', **model_accept_headers()},
+            )
 
 
 async def _call_with_return(model_id, adjust_message, return_message):
-    """Helper function for calling model service
+    """Helper function for calling model service. Results are cached by the content of the call, as the adjust and
+    return messages fully determine the answer of the model service, and concurrent identical calls share a single
+    request.
 
     :param model_id: str
-    :param adjust_message: dict
+    :param adjust_message: dict, preferably an AdjustMessage
     :param return_message: dict
     :return: dict
     """
-    message = deepcopy(adjust_message)
-    message.update(return_message)
-    call_result = await make_request(model_id, message)
+    if not isinstance(adjust_message, AdjustMessage):
+        adjust_message = AdjustMessage(adjust_message)
+    key = cache_key(model_id, adjust_message.digest(), return_message)
+    cached = await model_results.get(key)
+    if cached is not None:
+        return cached
+    async with request_call_slot():
+        with span('model', model_id):
+            return await model_calls.do(key, _fetch_with_return, key, model_id, adjust_message, return_message)
+
+
+async def _fetch_with_return(key, model_id, adjust_message, return_message):
+    call_result, size = await make_request(model_id, adjust_message.with_return(return_message),
+                                           read_response=read_sized_model_response)
     result = {
         'model_id': call_result['model-id'],
     }
-    for key in return_message['to-return']:
-        result[key] = call_result[key]
+    for return_key in return_message['to-return']:
+        result[return_key] = call_result[return_key]
+    await model_results.set(key, result, size)
     return result
 
 
@@ -303,18 +507,54 @@ async def fluxes(model_id, adjust_message, method=None, map=None):
     return await _call_with_return(model_id, adjust_message, return_message)
 
 
-async def gather_for_phases(samples, function):
-    phase_items = list(scalars_by_phases(samples).items())
-    result = await asyncio.gather(*[function(samples, scalars)
-                                    for phase, scalars in phase_items])
+async def gather_for_phases(samples, function, scalars=None, group_message=None):
+    """Call function for every phase of the sample group concurrently. If one phase fails, or the caller is cancelled,
+    the other phases are cancelled.
+
+    :param samples: list of ILoop sample objects that make up a valid sample group (replicates)
+    :param function: coroutine function taking samples, the grouped scalars for a phase and the group_message keyword
+    :param scalars: result of scalars_by_phases for samples, computed if not given
+    :param group_message: result of sample_group_message for samples, extracted if not given
+    :return: dict of results by phase id
+    """
+    if scalars is None:
+        scalars = await run_iloop(scalars_by_phases, samples)
+    if group_message is None:
+        group_message = await run_iloop(sample_group_message, samples)
+    phase_items = list(scalars.items())
+    result = await gather_cancelling(*[function(samples, scalars, group_message=group_message)
+                                       for phase, scalars in phase_items])
     phases = [p for p, _ in phase_items]
     return dict(zip(phases, result))
 
 
-async def fluxes_for_phase(samples, scalars, method=None, map=None, model_id=None, objective=None):
+async def phases_as_completed(samples, function, scalars, group_message):
+    """Call function for every phase of the sample group concurrently, like gather_for_phases, yielding each
+    (phase id, result) pair as soon as it is available. The phases still running are cancelled when the generator is
+    closed before it is exhausted, e.g. because the client disconnected.
+
+    :param samples: list of ILoop sample objects that make up a valid sample group (replicates)
+    :param function: coroutine function taking samples, the grouped scalars for a phase and the group_message keyword
+    :param scalars: result of scalars_by_phases for samples
+    :param group_message: result of sample_group_message for samples
+    """
+    async def for_phase(phase, scalars_for_phase):
+        return phase, await function(samples, scalars_for_phase, group_message=group_message)
+
+    futures = [asyncio.ensure_future(for_phase(phase, s)) for phase, s in scalars.items()]
+    try:
+        for result in asyncio.as_completed(futures):
+            yield await result
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+async def fluxes_for_phase(samples, scalars, method=None, map=None, model_id=None, objective=None, group_message=None):
     if model_id is None:
-        model_id = sample_model_id(samples[0])
-    return await fluxes(model_id, message_for_adjust(samples, scalars, objective), method=method, map=map)
+        model_id = await run_iloop(sample_model_id, samples[0])
+    adjust_message = await run_iloop(message_for_adjust, samples, scalars, objective, group_message)
+    return await fluxes(model_id, adjust_message, method=method, map=map)
 
 
 async def tmy(model_id, adjust_message, objectives):
@@ -332,6 +572,56 @@ async def tmy(model_id, adjust_message, objectives):
     return await _call_with_return(model_id, adjust_message, return_message)
 
 
+wild_type_yields = TTLCache(Default.WILD_TYPE_CACHE_SIZE, Default.MODEL_CACHE_TTL)
+watch_cache('wild_type_yields', wild_type_yields)
+_wild_type_pending = {}
+_wild_type_waiters = {}
+_MISSING = object()
+
+
+async def _wait_wild_type(model_id, future):
+    """Wait for a wild type call shared between requests as for a model service call of the current request"""
+    async with request_call_slot():
+        with span('model', model_id):
+            return await wait_shared(future, _wild_type_waiters)
+
+
+async def wild_type_tmy(model_id, compound_ids):
+    """Get theoretical maximum yields for the unmodified model. These depend only on the model and the compound, so
+    they are cached per (model id, compound id) and only compounds that are neither cached nor already being
+    requested are sent to the model service.
+
+    :param model_id: str
+    :param compound_ids: list of chebi id strings in format chebi:12345
+    :return: dict of theoretical maximum yield by compound id
+    """
+    yields, waiting, missing = {}, {}, []
+    for compound_id in dict.fromkeys(compound_ids):
+        key = (model_id, compound_id)
+        value = wild_type_yields.get(key, _MISSING)
+        if value is not _MISSING:
+            yields[compound_id] = value
+        elif key in _wild_type_pending:
+            waiting[compound_id] = _wild_type_pending[key]
+        else:
+            missing.append(compound_id)
+    if missing:
+        future = start_shared(tmy, model_id, {}, missing)
+        for compound_id in missing:
+            _wild_type_pending[(model_id, compound_id)] = future
+        try:
+            result = await _wait_wild_type(model_id, future)
+        finally:
+            for compound_id in missing:
+                _wild_type_pending.pop((model_id, compound_id), None)
+        for compound_id in missing:
+            wild_type_yields.set((model_id, compound_id), result['tmy'][compound_id])
+            yields[compound_id] = result['tmy'][compound_id]
+    for compound_id, future in waiting.items():
+        yields[compound_id] = (await _wait_wild_type(model_id, future))['tmy'][compound_id]
+    return yields
+
+
 def tmy_to_dict(data):
     # TODO: replace with compatible message from the model service
     if not data:
@@ -346,16 +636,17 @@ def tmy_to_dict(data):
     )
 
 
-async def theoretical_maximum_yield_for_phase(samples, scalars, model_id=None):
+async def theoretical_maximum_yield_for_phase(samples, scalars, model_id=None, group_message=None):
     """Get theoretical maximum yields for phase scalars, with growth rates and measurements, both for modified and wild type
 
     :param samples: list of ILoop sample objects that make up a valid sample group (replicates)
     :param scalars: scalars from ILoop
     :param model_id: The model to use, e.g. iJO1366
+    :param group_message: result of sample_group_message for samples, extracted if not given
     :return: dict
     """
     if model_id is None:
-        model_id = sample_model_id(samples[0])
+        model_id = await run_iloop(sample_model_id, samples[0])
     growth_rate_scalars = [sc for _, sc in scalars.items() if sc[0].get('test', {}).get('type', '') == 'growth-rate']
     # should get no growth rate or one list of measurements
     if len(growth_rate_scalars) == 1:
@@ -364,12 +655,15 @@ async def theoretical_maximum_yield_for_phase(samples, scalars, model_id=None):
         growth_rate = dict(measurements=[0])
     else:
         raise RuntimeError('unexpected number of measured growth rates for sample group')
-    measurements = extract_measurements_for_phase(scalars)
+    measurements = await run_iloop(extract_measurements_for_phase, scalars)
     compound_measurements = [m for m in measurements if m['type'] == 'compound']
     compound_ids = [m['id'] for m in compound_measurements]
-    tmy_modified, tmy_wild_type = await asyncio.gather(*[
-        tmy(model_id, message_for_adjust(samples, scalars), compound_ids),
-        tmy(model_id, {}, compound_ids)
+    if group_message is None:
+        group_message = await run_iloop(sample_group_message, samples)
+    adjust_message = phase_message(group_message, measurements)
+    tmy_modified, tmy_wild_type = await gather_cancelling(*[
+        traced('tmy', tmy(model_id, adjust_message, compound_ids), 'modified'),
+        traced('tmy', wild_type_tmy(model_id, compound_ids), 'wild_type'),
     ])
     result = {
         'growth-rate': growth_rate['measurements'],
@@ -380,7 +674,7 @@ async def theoretical_maximum_yield_for_phase(samples, scalars, model_id=None):
             'flux': compound['measurements'],
             'phase-planes': {
                 'modified': tmy_to_dict(tmy_modified['tmy'][compound['id']]),
-                'wild': tmy_to_dict(tmy_wild_type['tmy'][compound['id']]),
+                'wild': tmy_to_dict(tmy_wild_type[compound['id']]),
             }
         }
     return result
@@ -405,13 +699,58 @@ async def model_json(model_id, adjust_message, with_fluxes=True, method=None, ma
     return await _call_with_return(model_id, adjust_message, return_message)
 
 
-async def model_for_phase(samples, scalars, with_fluxes=True, method=None, map=None, model_id=None, objective=None):
+def model_diff(base, model):
+    """Changes that turn one serialized model into another. For the lists of items with an id (reactions, metabolites,
+    genes) the changed or added items are given in full together with the ids of the removed ones, other keys are
+    given with their new value, or None if removed
+
+    :param base: model as dict
+    :param model: model as dict, usually the base model adjusted to some data
+    :return: dict, empty if the models are the same
+    """
+    diff = {}
+    for key in set(base) | set(model):
+        old, new = base.get(key), model.get(key)
+        if key in MODEL_LISTS and isinstance(old, list) and isinstance(new, list):
+            old_items = {item['id']: item for item in old}
+            new_ids = {item['id'] for item in new}
+            updated = [item for item in new if old_items.get(item['id']) != item]
+            removed = [item_id for item_id in old_items if item_id not in new_ids]
+            if updated or removed:
+                diff[key] = {'updated': updated, 'removed': removed}
+        elif old != new:
+            diff[key] = new
+    return diff
+
+
+def apply_model_diff(base, diff):
+    """Reverse of model_diff: the model obtained by applying diff to base, items added by the diff come last
+
+    :param base: model as dict
+    :param diff: result of model_diff
+    :return: model as dict
+    """
+    model = dict(base)
+    for key, change in diff.items():
+        if key in MODEL_LISTS and isinstance(change, dict) and isinstance(base.get(key), list):
+            updated = {item['id']: item for item in change['updated']}
+            removed = set(change['removed'])
+            items = [updated.pop(item['id'], item) for item in base[key] if item['id'] not in removed]
+            model[key] = items + list(updated.values())
+        elif change is None:
+            model.pop(key, None)
+        else:
+            model[key] = change
+    return model
+
+
+async def model_for_phase(samples, scalars, with_fluxes=True, method=None, map=None, model_id=None, objective=None,
+                          group_message=None):
     if model_id is None:
-        model_id = sample_model_id(samples[0])
-    return await model_json(model_id, message_for_adjust(samples, scalars, objective), with_fluxes=with_fluxes,
-                            method=method,
-                            map=map)
+        model_id = await run_iloop(sample_model_id, samples[0])
+    adjust_message = await run_iloop(message_for_adjust, samples, scalars, objective, group_message)
+    return await model_json(model_id, adjust_message, with_fluxes=with_fluxes, method=method, map=map)
 
 
-async def info_for_samples(samples, scalars):
-    return message_for_adjust(samples, scalars)
+async def info_for_samples(samples, scalars, group_message=None):
+    return await run_iloop(message_for_adjust, samples, scalars, group_message=group_message)
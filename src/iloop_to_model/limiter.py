@@ -0,0 +1,101 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+from contextvars import ContextVar
+
+from iloop_to_model.metrics import watch_limiter
+from iloop_to_model.settings import Default
+
+
+class Limiter(object):
+    """Asynchronous context manager limiting the number of concurrent tasks, keeping queueing statistics"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = 0
+        self.total = 0
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self._semaphore = None
+        self._loop = None
+
+    def _get_semaphore(self):
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.limit)
+            self._loop = loop
+        return self._semaphore
+
+    async def __aenter__(self):
+        semaphore = self._get_semaphore()
+        self.total += 1
+        if semaphore.locked():
+            self.queued += 1
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            self.wait_seconds += time.monotonic() - start
+        self.running += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.running -= 1
+        self._semaphore.release()
+
+
+class RequestRate(object):
+    """Space out calls made from any thread to at most `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block the calling thread until its call is due"""
+        with self._lock:
+            now = time.monotonic()
+            due = max(now, self._next)
+            self._next = due + self.interval
+        if due > now:
+            time.sleep(due - now)
+
+
+worker_limiter = Limiter(Default.MODEL_CONCURRENCY)
+watch_limiter('model_calls', worker_limiter)
+request_limiter = ContextVar('request_limiter', default=None)
+# limits the iLoop requests made in the current context, e.g. by the warm-up, when set to a RequestRate
+iloop_rate = ContextVar('iloop_rate', default=None)
+
+
+class request_call_slot(object):
+    """Wait for a free slot for a model service call within the current request, if it limits its calls. The slot within
+    the worker is taken by the call itself (see worker_limiter), which may be shared with other requests."""
+
+    async def __aenter__(self):
+        self.limiter = request_limiter.get()
+        if self.limiter is not None:
+            await self.limiter.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.limiter is not None:
+            await self.limiter.__aexit__(exc_type, exc, tb)
@@ -0,0 +1,182 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prometheus metrics, served at /metrics. When gunicorn runs several workers, PROMETHEUS_MULTIPROC_DIR must name a
+directory shared by them, so that /metrics aggregates the values of all workers whichever answers the scrape."""
+
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from aiohttp import web
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Gauge, Histogram, generate_latest, multiprocess)
+
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+REQUEST_SECONDS = Histogram('iloop_to_model_request_seconds', 'Time to answer requests', ['endpoint', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('iloop_to_model_requests_in_flight', 'Requests being answered', ['endpoint'],
+                           multiprocess_mode='livesum')
+STAGE_SECONDS = Histogram('iloop_to_model_stage_seconds', 'Time spent in each stage of answering requests', ['stage'])
+MODEL_CALL_SECONDS = Histogram('iloop_to_model_model_call_seconds', 'Latency of model service calls',
+                               ['endpoint', 'model_id'], buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 20, 40, 80))
+MODEL_CALLS_IN_FLIGHT = Gauge('iloop_to_model_model_calls_in_flight', 'Model service calls waiting for an answer',
+                              multiprocess_mode='livesum')
+CACHE_HITS = Gauge('iloop_to_model_cache_hits', 'Cache hits since the worker started', ['cache'],
+                   multiprocess_mode='sum')
+CACHE_MISSES = Gauge('iloop_to_model_cache_misses', 'Cache misses since the worker started', ['cache'],
+                     multiprocess_mode='sum')
+SINGLE_FLIGHT_CALLS = Gauge('iloop_to_model_single_flight_calls', 'Calls since the worker started', ['name'],
+                            multiprocess_mode='sum')
+SINGLE_FLIGHT_COALESCED = Gauge('iloop_to_model_single_flight_coalesced',
+                                'Calls served by a call already in flight since the worker started', ['name'],
+                                multiprocess_mode='sum')
+LIMITER_RUNNING = Gauge('iloop_to_model_limiter_running', 'Tasks running', ['name'], multiprocess_mode='livesum')
+LIMITER_WAITING = Gauge('iloop_to_model_limiter_waiting', 'Tasks waiting for a slot', ['name'],
+                        multiprocess_mode='livesum')
+LIMITER_QUEUED = Gauge('iloop_to_model_limiter_queued', 'Tasks that had to wait since the worker started', ['name'],
+                       multiprocess_mode='sum')
+LIMITER_WAIT_SECONDS = Gauge('iloop_to_model_limiter_wait_seconds', 'Time spent waiting since the worker started',
+                             ['name'], multiprocess_mode='sum')
+BREAKER_OPEN = Gauge('iloop_to_model_circuit_breaker_open', 'Whether calls to a service are suspended', ['name'],
+                     multiprocess_mode='max')
+BREAKER_REJECTED = Gauge('iloop_to_model_circuit_breaker_rejected', 'Calls rejected since the worker started',
+                         ['name'], multiprocess_mode='sum')
+
+current_endpoint = ContextVar('current_endpoint', default='')
+_caches = {}
+_single_flights = {}
+_limiters = {}
+_breakers = {}
+
+
+def watch_cache(name, cache):
+    """Export the hits and misses of a cache, e.g. a TTLCache"""
+    _caches[name] = cache
+
+
+def watch_single_flight(name, single_flight):
+    """Export the calls and coalesced calls of a SingleFlight"""
+    _single_flights[name] = single_flight
+
+
+def watch_limiter(name, limiter):
+    """Export the queueing statistics of a Limiter"""
+    _limiters[name] = limiter
+
+
+def watch_breaker(name, breaker):
+    """Export the state and the rejected calls of a CircuitBreaker"""
+    _breakers[name] = breaker
+
+
+def update_worker_gauges():
+    """Copy the statistics kept by the watched caches, single flights, limiters and circuit breakers of this worker to
+    the gauges"""
+    for name, cache in _caches.items():
+        CACHE_HITS.labels(name).set(cache.hits)
+        CACHE_MISSES.labels(name).set(cache.misses)
+    for name, single_flight in _single_flights.items():
+        SINGLE_FLIGHT_CALLS.labels(name).set(single_flight.calls)
+        SINGLE_FLIGHT_COALESCED.labels(name).set(single_flight.coalesced)
+    for name, limiter in _limiters.items():
+        LIMITER_RUNNING.labels(name).set(limiter.running)
+        LIMITER_WAITING.labels(name).set(limiter.waiting)
+        LIMITER_QUEUED.labels(name).set(limiter.queued)
+        LIMITER_WAIT_SECONDS.labels(name).set(limiter.wait_seconds)
+    for name, breaker in _breakers.items():
+        BREAKER_OPEN.labels(name).set(int(breaker.open))
+        BREAKER_REJECTED.labels(name).set(breaker.rejected)
+
+
+@contextmanager
+def observe_stage(stage):
+    """Record the time spent in the block as stage"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.monotonic() - start)
+
+
+def timed_stage(stage):
+    """Decorator recording the time spent in a function as stage"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with observe_stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def observe_model_call(model_id):
+    """Record the latency of a model service call, by the endpoint of the current request and the model id"""
+    MODEL_CALLS_IN_FLIGHT.inc()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        MODEL_CALL_SECONDS.labels(current_endpoint.get() or 'none', model_id).observe(time.monotonic() - start)
+        MODEL_CALLS_IN_FLIGHT.dec()
+
+
+def endpoint_name(request):
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else 'unmatched'
+
+
+async def metrics_middleware(app, handler):
+    """aiohttp middleware which records the time to answer requests, by response status, and the number of requests in
+    flight. Requests whose client disconnected before they were answered are recorded with status 499."""
+    async def middleware_handler(request):
+        endpoint = endpoint_name(request)
+        current_endpoint.set(endpoint)
+        in_flight = REQUESTS_IN_FLIGHT.labels(endpoint)
+        in_flight.inc()
+        start = time.monotonic()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as error:
+            status = error.status
+            raise
+        except asyncio.CancelledError:
+            status = 499
+            raise
+        finally:
+            REQUEST_SECONDS.labels(endpoint, str(status)).observe(time.monotonic() - start)
+            in_flight.dec()
+            update_worker_gauges()
+    return middleware_handler
+
+
+async def metrics_handler(request):
+    """Metrics of all workers in the Prometheus text format"""
+    update_worker_gauges()
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return web.Response(body=generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
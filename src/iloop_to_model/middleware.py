@@ -12,7 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from aiohttp import hdrs, web
+
 from . import raven_client
+from .compression import compress, negotiate_coding
+from .deadline import DeadlineExceeded, RequestScope, request_scope, within_deadline
+from .limiter import Limiter, request_limiter
+from .protocol import error_response
+from .settings import Default
 
 
 async def raven_middleware(app, handler):
@@ -24,3 +31,53 @@ async def raven_middleware(app, handler):
             raven_client.captureException()
             raise
     return middleware_handler
+
+
+async def compression_middleware(app, handler):
+    """aiohttp middleware which compresses response bodies of at least COMPRESSION_MIN_SIZE bytes with the best
+    content coding accepted by the client"""
+    async def middleware_handler(request):
+        response = await handler(request)
+        if type(response) is not web.Response or hdrs.CONTENT_ENCODING in response.headers:
+            return response
+        body = response.body
+        if not isinstance(body, bytes) or len(body) < Default.COMPRESSION_MIN_SIZE:
+            return response
+        coding = negotiate_coding(request.headers.get(hdrs.ACCEPT_ENCODING, ''))
+        if coding is None:
+            return response
+        response.body = await compress(body, coding)
+        response.headers[hdrs.CONTENT_ENCODING] = coding
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+        return response
+    return middleware_handler
+
+
+async def concurrency_middleware(app, handler):
+    """aiohttp middleware which limits the number of concurrent model service calls made for a single request"""
+    async def middleware_handler(request):
+        request_limiter.set(Limiter(Default.MODEL_REQUEST_CONCURRENCY))
+        return await handler(request)
+    return middleware_handler
+
+
+async def deadline_middleware(app, handler):
+    """aiohttp middleware which gives a request REQUEST_TIMEOUT seconds to be answered, with a 504 response when it
+    runs out of time, unless its handler enforces a deadline of its own (see enforces_deadline). The work still
+    running for the request once it is answered, has timed out or the client has disconnected (aiohttp then cancels the
+    handler) is cancelled."""
+    async def middleware_handler(request):
+        route_handler = request.match_info.handler
+        scope = RequestScope(getattr(route_handler, 'request_timeout', Default.REQUEST_TIMEOUT))
+        request_scope.set(scope)
+        try:
+            if getattr(route_handler, 'enforces_deadline', False):
+                return await handler(request)
+            return await within_deadline(handler(request))
+        except DeadlineExceeded as error:
+            if request.writer.output_size > 0:
+                raise  # a response already being streamed can only be cut off
+            return error_response(error)
+        finally:
+            scope.cancel()
+    return middleware_handler
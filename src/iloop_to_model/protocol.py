@@ -0,0 +1,174 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from base64 import b64encode
+
+from aiohttp import web
+from venom.common.messages import JSONValue
+from venom.exceptions import ErrorResponse
+from venom.message import Message
+from venom.protocol import JSONProtocol
+
+from iloop_to_model.metrics import observe_stage
+
+
+_writers = {}
+_converters = {}
+
+
+def _dumps_key(key):
+    return json.dumps(key if isinstance(key, str) else str(key))
+
+
+def _is_message(field):
+    return isinstance(field.type, type) and issubclass(field.type, Message)
+
+
+def _holds_json_value(message_type, seen=()):
+    """Whether messages of message_type can contain a JSONValue"""
+    if message_type is JSONValue:
+        return True
+    seen = seen + (message_type,)
+    return any(_holds_json_value(field.type, seen) for field in message_type.__fields__.values()
+               if _is_message(field) and field.type not in seen)
+
+
+def _repeat(field, convert):
+    """Apply convert to the single, repeated or mapped value of field"""
+    if field.repeated and field.key_type:
+        return lambda values: {key: convert(value) for key, value in values.items()}
+    if field.repeated:
+        return lambda values: [convert(value) for value in values]
+    return convert
+
+
+def _message_converter(message_type):
+    """Function converting a message of message_type to the dict venom's DictMessageTranscoder would encode it to, but
+    reusing the maps and lists of plain values instead of copying them item by item"""
+    try:
+        return _converters[message_type]
+    except KeyError:
+        pass
+    fields = []
+    for field in message_type.__fields__.values():
+        if _is_message(field):
+            convert = _repeat(field, lambda value: _message_converter(type(value))(value))
+        elif field.type is bytes:
+            convert = _repeat(field, lambda value: b64encode(value).decode())
+        else:
+            convert = None
+        fields.append((field.name, field.json_name, convert))
+
+    def convert_message(message):
+        obj = {}
+        for name, json_name, convert in fields:
+            if name in message:
+                value = message[name]
+                if value is not None:
+                    obj[json_name] = value if convert is None else convert(value)
+        return obj
+    _converters[message_type] = convert_message
+    return convert_message
+
+
+def _field_writer(field):
+    """Function writing the value of field to a list of JSON fragments"""
+    if not _is_message(field):
+        convert = _repeat(field, lambda value: b64encode(value).decode()) if field.type is bytes else None
+        return lambda value, parts: parts.append(json.dumps(value if convert is None else convert(value)))
+
+    def write_value(value, parts):
+        if field.type is JSONValue:
+            # JSONValue already holds its content serialized, there is no need to decode and encode it again
+            parts.append(value['value'])
+        else:
+            _message_writer(type(value))(value, parts)
+
+    if field.repeated and field.key_type:
+        def write_map(values, parts):
+            parts.append('{')
+            for i, (key, value) in enumerate(values.items()):
+                if i:
+                    parts.append(', ')
+                parts.append(_dumps_key(key))
+                parts.append(': ')
+                write_value(value, parts)
+            parts.append('}')
+        return write_map
+    if field.repeated:
+        def write_list(values, parts):
+            parts.append('[')
+            for i, value in enumerate(values):
+                if i:
+                    parts.append(', ')
+                write_value(value, parts)
+            parts.append(']')
+        return write_list
+    return write_value
+
+
+def _message_writer(message_type):
+    """Function writing a message of message_type to a list of JSON fragments, built once per type. Messages that
+    cannot contain a JSONValue are converted to a dict and dumped in a single call."""
+    try:
+        return _writers[message_type]
+    except KeyError:
+        pass
+    if not _holds_json_value(message_type):
+        convert = _message_converter(message_type)
+        _writers[message_type] = lambda message, parts: parts.append(json.dumps(convert(message)))
+        return _writers[message_type]
+    fields = [(field.name, json.dumps(field.json_name) + ': ', _field_writer(field))
+              for field in message_type.__fields__.values()]
+
+    def write_message(message, parts):
+        parts.append('{')
+        first = True
+        for name, key, write in fields:
+            if name not in message:
+                continue
+            value = message[name]
+            if value is None:
+                continue
+            if not first:
+                parts.append(', ')
+            first = False
+            parts.append(key)
+            write(value, parts)
+        parts.append('}')
+    _writers[message_type] = write_message
+    return write_message
+
+
+class FastJSONProtocol(JSONProtocol):
+    """JSONProtocol producing the same output with less work: JSONValue fields (e.g. models) are embedded as they are
+    instead of being decoded and encoded again, everything else is dumped in as few calls as possible and maps and
+    lists of plain values (e.g. fluxes) are not copied."""
+
+    def packs(self, message):
+        if self.is_empty:
+            return ''
+        if self.field_mask:
+            return super().packs(message)
+        with observe_stage('serialization'):
+            parts = []
+            _message_writer(type(message))(message, parts)
+            return ''.join(parts)
+
+
+def error_response(error):
+    """aiohttp response for a venom error, as venom answers the errors raised by its methods"""
+    protocol = FastJSONProtocol(ErrorResponse)
+    return web.Response(body=protocol.pack(error.format()), content_type=protocol.mime, status=error.http_status)
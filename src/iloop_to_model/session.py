@@ -0,0 +1,55 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import aiohttp
+
+from iloop_to_model.settings import Default
+
+
+_session = None
+_session_loop = None
+
+
+def model_session():
+    """Shared HTTP session for calls to the model service, one connection pool per worker
+
+    The session is normally opened on application startup; it is created on first use (or when the event loop has
+    changed, as happens between tests) otherwise.
+
+    :return: aiohttp.ClientSession
+    """
+    global _session, _session_loop
+    loop = asyncio.get_event_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=Default.MODEL_CONNECTIONS,
+            limit_per_host=Default.MODEL_CONNECTIONS_PER_HOST,
+            keepalive_timeout=Default.MODEL_KEEPALIVE_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+    return _session
+
+
+async def open_model_session(app):
+    model_session()
+
+
+async def close_model_session(app):
+    global _session, _session_loop
+    if _session is not None:
+        await _session.close()
+    _session = _session_loop = None
@@ -30,3 +30,36 @@ class Default(object):
     ILOOP_TOKEN = os.environ['ILOOP_TOKEN']
     MODEL_API = os.environ['MODEL_API']
     SENTRY_DSN = os.environ.get('SENTRY_DSN', '')
+    ILOOP_WORKERS = int(os.environ.get('ILOOP_WORKERS', 8))
+    MODEL_CONNECTIONS = int(os.environ.get('MODEL_CONNECTIONS', 100))
+    MODEL_CONNECTIONS_PER_HOST = int(os.environ.get('MODEL_CONNECTIONS_PER_HOST', 20))
+    MODEL_KEEPALIVE_TIMEOUT = float(os.environ.get('MODEL_KEEPALIVE_TIMEOUT', 30))
+    MODEL_MSGPACK = os.environ.get('MODEL_MSGPACK', '1') not in ('', '0', 'false', 'False')
+    MODEL_TIMEOUT = float(os.environ.get('MODEL_TIMEOUT', 15))
+    MODEL_RETRIES = int(os.environ.get('MODEL_RETRIES', 2))
+    MODEL_RETRY_BACKOFF = float(os.environ.get('MODEL_RETRY_BACKOFF', 0.1))
+    MODEL_RETRY_BACKOFF_MAX = float(os.environ.get('MODEL_RETRY_BACKOFF_MAX', 2))
+    MODEL_BREAKER_THRESHOLD = int(os.environ.get('MODEL_BREAKER_THRESHOLD', 5))
+    MODEL_BREAKER_RESET = float(os.environ.get('MODEL_BREAKER_RESET', 10))
+    REQUEST_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 18))
+    STREAM_TIMEOUT = float(os.environ.get('STREAM_TIMEOUT', 300))
+    MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', 64))
+    MODEL_CACHE_BYTES = int(os.environ.get('MODEL_CACHE_BYTES', 64 * 1024 * 1024))
+    MODEL_CACHE_TTL = float(os.environ.get('MODEL_CACHE_TTL', 3600))
+    WILD_TYPE_CACHE_SIZE = int(os.environ.get('WILD_TYPE_CACHE_SIZE', 4096))
+    REDIS_URL = os.environ.get('REDIS_URL', '')
+    COMPRESSION_CODINGS = [c.strip() for c in os.environ.get('COMPRESSION_CODINGS', 'zstd,br,gzip').split(',')
+                           if c.strip()]
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+    COMPRESSION_EXECUTOR_SIZE = int(os.environ.get('COMPRESSION_EXECUTOR_SIZE', 262144))
+    BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 4))
+    MODEL_CONCURRENCY = int(os.environ.get('MODEL_CONCURRENCY', 16))
+    MODEL_REQUEST_CONCURRENCY = int(os.environ.get('MODEL_REQUEST_CONCURRENCY', 4))
+    EXPERIMENT_INDEX_TTL = float(os.environ.get('EXPERIMENT_INDEX_TTL', 3600))
+    EXPERIMENT_INDEX_INTERVAL = float(os.environ.get('EXPERIMENT_INDEX_INTERVAL', 300))
+    ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', 10000))
+    ENTITY_CACHE_TTL = float(os.environ.get('ENTITY_CACHE_TTL', 3600))
+    WARMUP_INTERVAL = float(os.environ.get('WARMUP_INTERVAL', 0))
+    WARMUP_SCOPE = os.environ.get('WARMUP_SCOPE', 'active,recent')
+    WARMUP_EXPERIMENTS = int(os.environ.get('WARMUP_EXPERIMENTS', 20))
+    WARMUP_RATE = float(os.environ.get('WARMUP_RATE', 5))
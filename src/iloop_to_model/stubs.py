@@ -75,6 +75,10 @@ class ModelRequestMessage(Message):
     objective = String(description='Reaction ID to be set as objective')
 
 
+class ModelRequestsMessage(Message):
+    requests = repeated(ModelRequestMessage)
+
+
 class PhasePlaneMessage(Message):
     objective_upper_bound = repeated(Float32(description='Upper bound for theoretical yield objective'))
     objective_lower_bound = repeated(Float32(description='Lower bound for theoretical yield objective'))
@@ -105,6 +109,24 @@ class ModelMessage(Message):
     model: JSONValue
 
 
+class PhaseModelMessage(Message):
+    phase_id = Int(description='Phase ID')
+    response: ModelMessage
+
+
+class ModelDiffMessage(Message):
+    model_id = String(description='The saved model ID which can be used for retrieving cached information')
+    fluxes = map_(Float32())
+    growth_rate = Float32(description='Growth rate for this simulation')
+    changes: JSONValue
+
+
+class ModelsDiffMessage(Message):
+    base_phase_id = Int(description='Phase ID of the model in base, its changes are empty')
+    base: JSONValue
+    response = map_(ModelDiffMessage)
+
+
 class ExperimentsMessage(Message):
     response = repeated(ExperimentMessage)
 
@@ -138,5 +160,23 @@ class ModelsMessage(Message):
     response = map_(ModelMessage)
 
 
+class WarmupStatusMessage(Message):
+    running = Bool(description='Whether a warm-up round is in progress')
+    rounds = Int(description='Number of completed warm-up rounds')
+    experiments_total = Int(description='Number of experiments to warm in the current or last round')
+    experiments_warmed = Int(description='Number of experiments warmed so far in the current or last round')
+    errors = Int(description='Number of experiments that failed to warm since startup')
+    last_started = Float32(description='Unix time the current or last round started')
+    last_finished = Float32(description='Unix time the last round finished')
+
+
 class SampleModelsMessage(Message):
     response = repeated(String(description='Possible models for the sample'))
+
+
+class MaximumYieldsBatchMessage(Message):
+    response = repeated(MaximumYieldsMessage)
+
+
+class ModelsBatchMessage(Message):
+    response = repeated(ModelsMessage)
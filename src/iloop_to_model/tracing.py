@@ -0,0 +1,124 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in per request tracing. A request with the header `X-Trace: 1` is answered with a Server-Timing header
+summing the time spent per kind of span, and an X-Trace header with the timeline of all spans, e.g.
+
+    X-Trace: iloop:fetch_samples@0+35 iloop:sample_group_message@36+812 model:iJO1366@850+4210
+
+where every span is given as name:detail@start+duration, in milliseconds since the request started."""
+
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from aiohttp import web
+
+
+TRACE_HEADER = 'X-Trace'
+MAX_TIMELINE_SPANS = 200
+
+current_trace = ContextVar('current_trace', default=None)
+
+
+class Span(object):
+    __slots__ = ('trace', 'name', 'detail', 'start', 'duration')
+
+    def __init__(self, trace, name, detail):
+        self.trace = trace
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.monotonic() - self.start
+        self.trace.spans.append(self)
+
+
+class _NoSpan(object):
+    """Span doing nothing, used when the request is not traced"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+class Trace(object):
+    """Spans recorded while answering a request"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.spans = []
+
+    def server_timing(self):
+        """Server-Timing header value: total duration and count of the spans by name, and the total request time"""
+        totals = OrderedDict()
+        for span in self.spans:
+            duration, count = totals.get(span.name, (0.0, 0))
+            totals[span.name] = duration + span.duration, count + 1
+        metrics = ['{};desc="{}x";dur={:.1f}'.format(name, count, duration * 1000)
+                   for name, (duration, count) in totals.items()]
+        metrics.append('total;dur={:.1f}'.format((time.monotonic() - self.start) * 1000))
+        return ', '.join(metrics)
+
+    def timeline(self):
+        """X-Trace header value: the spans in order of start, see the module documentation"""
+        spans = sorted(self.spans, key=lambda span: span.start)
+        parts = ['{}{}@{:.0f}+{:.0f}'.format(span.name, ':' + span.detail if span.detail else '',
+                                             (span.start - self.start) * 1000, span.duration * 1000)
+                 for span in spans[:MAX_TIMELINE_SPANS]]
+        if len(spans) > MAX_TIMELINE_SPANS:
+            parts.append('...{}-more'.format(len(spans) - MAX_TIMELINE_SPANS))
+        return ' '.join(parts)
+
+
+def span(name, detail=''):
+    """Context manager recording a span in the trace of the current request, doing nothing if it is not traced
+
+    :param name: kind of span, e.g. iloop or model
+    :param detail: str, e.g. the called function or model id
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return _no_span
+    return Span(trace, name, str(detail).replace(' ', '_'))
+
+
+async def traced(name, awaitable, detail=''):
+    """Await awaitable within a span"""
+    with span(name, detail):
+        return await awaitable
+
+
+async def tracing_middleware(app, handler):
+    """aiohttp middleware which traces requests asking for it with the X-Trace header"""
+    async def middleware_handler(request):
+        if request.headers.get(TRACE_HEADER, '') in ('', '0'):
+            return await handler(request)
+        trace = Trace()
+        current_trace.set(trace)
+        response = await handler(request)
+        if isinstance(response, web.Response):
+            response.headers['Server-Timing'] = trace.server_timing()
+            response.headers[TRACE_HEADER] = trace.timeline()
+        return response
+    return middleware_handler
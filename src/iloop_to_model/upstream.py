@@ -0,0 +1,161 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Calls to the model service with a timeout per attempt, bounded retries with jittered backoff, and a circuit breaker
+which fails fast while the model service keeps failing. Failures are raised as venom errors, so that they are
+answered with a 502, 503 or 504 response instead of an internal server error."""
+
+import asyncio
+import random
+import time
+
+import aiohttp
+from venom.exceptions import Error
+
+from iloop_to_model.deadline import remaining
+from iloop_to_model.metrics import watch_breaker
+from iloop_to_model.session import model_session
+from iloop_to_model.settings import Default
+
+
+RETRY_STATUSES = {502, 503, 504}
+
+
+class ModelServiceError(Error):
+    http_status = 502
+    description = 'Model service error'
+
+
+class ModelServiceUnavailable(ModelServiceError):
+    http_status = 503
+    description = 'Model service unavailable'
+
+
+class ModelServiceTimeout(ModelServiceError):
+    http_status = 504
+    description = 'Model service timeout'
+
+
+class CircuitBreaker(object):
+    """Stop calling a service after `threshold` consecutive failures. Calls are rejected for `reset_timeout` seconds,
+    then a single probe call is let through, and its outcome closes the breaker or opens it again."""
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Whether a call may be made now; a call which is allowed must be followed by success(), failure() or
+        release()"""
+        if not self.threshold or self.opened_at is None:
+            return True
+        if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or (self.threshold and self.failures >= self.threshold):
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        """Forget about a call that ended without telling whether the service is healthy, e.g. as it was cancelled"""
+        self.probing = False
+
+
+model_breaker = CircuitBreaker(Default.MODEL_BREAKER_THRESHOLD, Default.MODEL_BREAKER_RESET)
+watch_breaker('model', model_breaker)
+
+
+def attempt_timeout():
+    """Timeout for the next attempt: MODEL_TIMEOUT, cut to what is left of the budget of the current request"""
+    budget = remaining()
+    if budget is None:
+        return Default.MODEL_TIMEOUT
+    return min(Default.MODEL_TIMEOUT, budget)
+
+
+def backoff(attempt):
+    """Seconds to wait before retrying, with full jitter so that the retries of concurrent calls spread out"""
+    return random.uniform(0, min(Default.MODEL_RETRY_BACKOFF_MAX, Default.MODEL_RETRY_BACKOFF * 2 ** attempt))
+
+
+async def call_model_service(method, url, read_response, idempotent=True, **kwargs):
+    """Call the model service. Idempotent calls are retried, up to MODEL_RETRIES times, after timeouts, connection
+    errors and 502, 503 or 504 responses, as long as the budget of the current request allows.
+
+    :param method: HTTP method
+    :param url: str
+    :param read_response: coroutine function decoding a successful aiohttp client response
+    :param idempotent: whether the call may be repeated
+    :param kwargs: passed on to aiohttp.ClientSession.request
+    :return: the decoded response
+    :raises ModelServiceError: for an unsuccessful response, or ModelServiceTimeout and ModelServiceUnavailable
+    """
+    retries = Default.MODEL_RETRIES if idempotent else 0
+    for attempt in range(retries + 1):
+        timeout = attempt_timeout()
+        if timeout <= 0:
+            raise ModelServiceTimeout('Request deadline exceeded before calling the model service')
+        if not model_breaker.allow():
+            raise ModelServiceUnavailable('Model service calls suspended after repeated failures')
+        try:
+            async with model_session().request(method, url, timeout=aiohttp.ClientTimeout(total=timeout),
+                                               **kwargs) as r:
+                if r.status == 200:
+                    result = await read_response(r)
+                    model_breaker.success()
+                    return result
+                error = ModelServiceError('Response status {} from model service: {}'.format(
+                    r.status, (await r.text())[:200]))
+                retry = r.status in RETRY_STATUSES
+                if r.status >= 500:
+                    model_breaker.failure()
+                else:
+                    model_breaker.success()
+        except asyncio.TimeoutError:
+            if timeout < Default.MODEL_TIMEOUT:
+                model_breaker.release()  # out of request budget, which says nothing about the model service
+            else:
+                model_breaker.failure()
+            error, retry = ModelServiceTimeout('No response from model service within {:.1f}s'.format(timeout)), True
+        except aiohttp.ClientError as e:
+            model_breaker.failure()
+            error, retry = ModelServiceError('Model service request failed: {!r}'.format(e)), True
+        except BaseException:
+            model_breaker.release()
+            raise
+        if not retry or attempt == retries:
+            raise error
+        delay = backoff(attempt)
+        budget = remaining()
+        if budget is not None and budget <= delay:
+            raise error
+        await asyncio.sleep(delay)
@@ -0,0 +1,122 @@
+# Copyright 2018 Novo Nordisk Foundation Center for Biosustainability, DTU.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+from collections import OrderedDict
+
+from iloop_to_model import iloop_client, logger, run_iloop
+from iloop_to_model.cache import iloop_entities
+from iloop_to_model.iloop_to_model import extract_genotype_changes, extract_medium
+from iloop_to_model.limiter import RequestRate, iloop_rate
+from iloop_to_model.settings import Default
+
+
+def warm_sample(sample):
+    """Resolve what requests for the sample read through the iLoop entity cache: the strain with its organism and
+    lineage (pools included), and the media with their contents"""
+    extract_genotype_changes(sample.strain)
+    iloop_entities.resolve(sample.strain).organism.short_code
+    for medium in (sample.medium, sample.feed_medium):
+        iloop_entities.resolve(medium)
+        extract_medium(medium)
+
+
+class Warmer(object):
+    """Background task prefetching the strains, pools and media of the samples of experiments into the iLoop entity
+    cache. Measurements are not cached, so they are not read.
+
+    Entities are cached per token, so experiments are warmed with the token they were requested with ('active' scope).
+    With the 'recent' scope, the most recent fermentation experiments are also warmed with the service token, which
+    covers the time right after a deploy. iLoop calls are made one at a time, and the HTTP requests they make are
+    spaced out to at most `rate` per second.
+    """
+
+    def __init__(self, scope, experiments, rate):
+        self.scope = scope
+        self.experiments = experiments
+        self.rate = rate
+        self._active = OrderedDict()
+        self.status = {
+            'running': False,
+            'rounds': 0,
+            'experiments_total': 0,
+            'experiments_warmed': 0,
+            'errors': 0,
+            'last_started': 0.0,
+            'last_finished': 0.0,
+        }
+
+    def record(self, api, token, experiment_id):
+        """Remember an experiment a user has opened, so it is kept warm"""
+        key = (api, token, experiment_id)
+        self._active.pop(key, None)
+        self._active[key] = time.time()
+        while len(self._active) > self.experiments:
+            self._active.popitem(last=False)
+
+    async def _recent(self):
+        if 'recent' not in self.scope or not Default.ILOOP_TOKEN:
+            return []
+        iloop = await run_iloop(iloop_client, Default.ILOOP_API, Default.ILOOP_TOKEN)
+        experiments = await run_iloop(
+            lambda: [e.id for e in iloop.Experiment.instances(where=dict(type='fermentation'))])
+        return [(Default.ILOOP_API, Default.ILOOP_TOKEN, experiment_id)
+                for experiment_id in sorted(experiments, reverse=True)[:self.experiments]]
+
+    async def warm_experiment(self, api, token, experiment_id):
+        iloop = await run_iloop(iloop_client, api, token)
+        samples = await run_iloop(lambda: list(iloop.Experiment(experiment_id).read_samples()))
+        for sample in samples:
+            await run_iloop(warm_sample, sample)
+
+    async def warm(self):
+        if self.rate > 0:
+            iloop_rate.set(RequestRate(self.rate))
+        targets = list(self._active) if 'active' in self.scope else []
+        targets = list(dict.fromkeys(targets[::-1] + await self._recent()))
+        self.status.update(running=True, last_started=time.time(), experiments_total=len(targets),
+                           experiments_warmed=0)
+        try:
+            for api, token, experiment_id in targets:
+                try:
+                    await self.warm_experiment(api, token, experiment_id)
+                    self.status['experiments_warmed'] += 1
+                except Exception as error:
+                    self.status['errors'] += 1
+                    logger.info('Warming experiment {} failed: {}'.format(experiment_id, error))
+        finally:
+            self.status.update(running=False, last_finished=time.time(), rounds=self.status['rounds'] + 1)
+
+    async def run(self, interval):
+        while True:
+            try:
+                await self.warm()
+            except Exception as error:
+                logger.warning('Cache warm-up failed: {}'.format(error))
+            await asyncio.sleep(interval)
+
+
+warmer = Warmer(set(Default.WARMUP_SCOPE.split(',')), Default.WARMUP_EXPERIMENTS, Default.WARMUP_RATE)
+
+
+async def start_warmer(app):
+    if Default.WARMUP_INTERVAL > 0:
+        app['warmer'] = asyncio.ensure_future(warmer.run(Default.WARMUP_INTERVAL))
+
+
+async def stop_warmer(app):
+    task = app.get('warmer')
+    if task is not None:
+        task.cancel()
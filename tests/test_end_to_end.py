@@ -65,6 +65,9 @@ class EndToEndTestCase(AioHTTPTestCase):
             ('/iloop-to-model/data-adjusted/model', payload),
             ('/iloop-to-model/data-adjusted/fluxes', payload),
             ('/iloop-to-model/data-adjusted/maximum-yield', payload),
+            ('/iloop-to-model/data-adjusted/fluxes/batch', {'requests': [payload, payload_objective]}),
+            ('/iloop-to-model/data-adjusted/maximum-yield/batch', {'requests': [payload]}),
+            ('/iloop-to-model/data-adjusted/model/batch', {'requests': [payload, payload_objective]}),
         ]
         for url in get_queries:
             r = await self.client.get(url)
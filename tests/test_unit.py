@@ -12,13 +12,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import json
+import threading
+import time
 from collections import namedtuple
+from itertools import chain
 
+import msgpack
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from potion_client.resource import Resource
+from prometheus_client import generate_latest
+from venom.protocol import JSONProtocol
 
-from iloop_to_model.app import name_groups
+import iloop_to_model.app
+import iloop_to_model.iloop_to_model
+import iloop_to_model.upstream
+import iloop_to_model.warmup
+from iloop_to_model import run_iloop
+from iloop_to_model.app import name_groups, sample_groups_for_experiment, stream_sample_model
+from iloop_to_model.cache import EntityCache, ResultCache, SingleFlight, TTLCache, cache_key, iloop_entities
+from iloop_to_model.compression import negotiate_coding
+from iloop_to_model.deadline import (
+    DeadlineExceeded, RequestCancelled, RequestScope, check_scope, gather_cancelling, remaining, request_scope)
+from iloop_to_model.experiment_index import ExperimentIndex
 from iloop_to_model.iloop_to_model import (
-    MEASUREMENTS, MEDIUM, extract_genotype_changes, message_for_adjust, phases_for_samples, scalars_by_phases)
+    MEASUREMENTS, MEDIUM, AdjustMessage, apply_model_diff, extract_genotype_changes, fetch_samples, fluxes,
+    message_for_adjust, model_diff, phase_message, phases_as_completed, phases_for_samples, read_model_response,
+    read_sized_model_response, sample_group_message, scalars_by_phases, strain_lineage, wild_type_tmy)
+from iloop_to_model.limiter import Limiter, RequestRate, request_limiter
+from iloop_to_model.metrics import metrics_middleware, observe_stage, update_worker_gauges, watch_cache
+from iloop_to_model.middleware import deadline_middleware
+from iloop_to_model.protocol import FastJSONProtocol
+from iloop_to_model.settings import Default
+from iloop_to_model.stubs import (
+    JSONValue, MaximumYieldMessage, MaximumYieldsMessage, MetabolitePhasePlaneMessage, ModelMessage, ModelsBatchMessage,
+    ModelsMessage, PhasePlaneMessage, PhasePlanesMessage, SampleMessage, SamplesMessage)
+from iloop_to_model.tracing import Trace, current_trace, span, traced, tracing_middleware
+from iloop_to_model.upstream import CircuitBreaker, ModelServiceError, ModelServiceTimeout, call_model_service
+from iloop_to_model.warmup import Warmer
 
 
 Sample = namedtuple('Sample',
@@ -92,6 +126,32 @@ s2 = Sample(2, strain, medium, medium, lambda: scalars, 'S2', lambda type: xrefs
 s3 = Sample(3, strain, medium, medium, lambda: scalars, 'S3', lambda type: xrefs[type], experiment_tricky)
 samples_args = [[s1], [s1, s2]]
 
+GroupStrain = namedtuple('GroupStrain', ['id', 'pool', 'organism'])
+Entity = namedtuple('Entity', ['id', 'identifier', 'name'])
+ExperimentSamples = namedtuple('ExperimentSamples', ['read_samples', 'attributes'])
+pools = {1: Entity(1, 'P1', None), 2: Entity(2, 'P2', None)}
+media = {i: Entity(i, None, 'M{}'.format(i)) for i in (1, 2, 3)}
+strain_a = GroupStrain(10, pools[1], organism)
+strain_b = GroupStrain(11, pools[1], organism)
+strain_c = GroupStrain(12, pools[2], Organism('SCE'))
+experiment_samples = [
+    Sample(1, strain_a, media[1], None, None, 'S1', None, None),
+    Sample(2, strain_a, media[1], None, None, 'S2', None, None),
+    Sample(3, strain_b, media[1], None, None, 'S3', None, None),
+    Sample(4, strain_c, media[1], None, None, 'S4', None, None),
+    Sample(5, strain_a, media[2], media[3], None, 'S5', None, None),
+]
+
+
+class GroupingIloop(object):
+    Pool = staticmethod(lambda pool_id: pools[pool_id])
+    Medium = staticmethod(lambda medium_id: media[medium_id])
+
+    @staticmethod
+    def Experiment(experiment_id):
+        operation = {sample.name: 'batch' for sample in experiment_samples}
+        return ExperimentSamples(lambda: experiment_samples, {'operation': operation})
+
 
 @pytest.mark.parametrize('samples', samples_args)
 def test_message_for_adjust(samples):
@@ -114,6 +174,130 @@ async def test_phases_for_sample(samples):
     assert await phases_for_samples(samples) == [{'id': 1, 'name': 'phase1 (0 - 14 hours)'}]
 
 
+@pytest.mark.parametrize('samples', samples_args)
+def test_scalars_by_phases_for_phase(samples):
+    assert scalars_by_phases(samples, phase_id=1) == scalars_by_phases(samples)
+    assert scalars_by_phases(samples, phase_id=2) == {}
+
+
+@pytest.mark.asyncio
+async def test_phases_as_completed():
+    async def slow_for_first(samples, scalars, group_message=None):
+        await asyncio.sleep(0.01 if scalars == 'first' else 0)
+        return scalars, group_message
+
+    results = [item async for item in phases_as_completed([s1], slow_for_first, {1: 'first', 2: 'second'}, 'group')]
+    assert results == [(2, ('second', 'group')), (1, ('first', 'group'))]
+
+
+def test_model_diff():
+    base = {'id': 'm', 'reactions': [{'id': 'R1', 'lower_bound': 0}, {'id': 'R2', 'lower_bound': 0}], 'notes': 'x'}
+    model = {'id': 'm', 'reactions': [{'id': 'R1', 'lower_bound': -10}, {'id': 'R3', 'lower_bound': 0}], 'obj': 'R1'}
+    diff = model_diff(base, model)
+    assert diff == {
+        'reactions': {'updated': [{'id': 'R1', 'lower_bound': -10}, {'id': 'R3', 'lower_bound': 0}],
+                      'removed': ['R2']},
+        'notes': None,
+        'obj': 'R1',
+    }
+    assert apply_model_diff(base, diff) == model
+    assert model_diff(model, model) == {}
+
+
+def test_negotiate_coding():
+    codings = ['zstd', 'br', 'gzip']
+    assert negotiate_coding('gzip, deflate, br', codings) == 'br'
+    assert negotiate_coding('gzip, br;q=0.5', codings) == 'gzip'
+    assert negotiate_coding('*, zstd;q=0', codings) == 'br'
+    assert negotiate_coding('identity', codings) is None
+    assert negotiate_coding('', codings) is None
+    assert negotiate_coding('gzip;q=0.5, br', ['gzip']) == 'gzip'
+
+
+@pytest.mark.asyncio
+async def test_read_model_response():
+    class Response:
+        def __init__(self, content_type, body):
+            self.content_type = content_type
+            self.body = body
+
+        async def read(self):
+            return self.body
+
+        async def json(self):
+            return json.loads(self.body.decode())
+
+    message = {'model-id': 'iJO1366', 'fluxes': {'R1': 1.5}}
+    assert await read_model_response(Response('application/msgpack', msgpack.packb(message))) == message
+    assert await read_model_response(Response('application/json', json.dumps(message).encode())) == message
+    body = msgpack.packb(message)
+    assert await read_sized_model_response(Response('application/msgpack', body)) == (message, len(body))
+
+
+def test_fast_json_protocol():
+    messages = [
+        ModelsMessage(response={1: ModelMessage(model_id='m', fluxes={'R1': 1.5, 'R2': -0.25}, growth_rate=0.5,
+                                                model=JSONValue({'id': 'm', 'reactions': [{'id': 'R1'}]}))}),
+        ModelsBatchMessage(response=[ModelsMessage(response={}),
+                                     ModelsMessage(response={2: ModelMessage(model_id='x')})]),
+        MaximumYieldsMessage(response={1: MaximumYieldMessage(growth_rate=[0.1], metabolites={
+            'glc': MetabolitePhasePlaneMessage(flux=[1.0], phase_planes=PhasePlanesMessage(
+                wild=PhasePlaneMessage(objective=[0.5], objective_id='EX_glc'))),
+        })}),
+        SamplesMessage(response=[SampleMessage(id=[1, 2], name='S "1"', organism='ECO')]),
+        ModelMessage(),
+    ]
+    for message in messages:
+        expected = JSONProtocol(type(message)).pack(message)
+        assert FastJSONProtocol(type(message)).pack(message) == expected
+        assert isinstance(json.loads(expected.decode()), dict)
+
+
+def test_adjust_message():
+    group_message = sample_group_message([s1])
+    message = message_for_adjust([s1], scalars_by_phases([s1])[1], group_message=group_message)
+    assert isinstance(message, AdjustMessage) and message.base is group_message
+    return_message = {'to-return': ['fluxes'], 'map': 'Central metabolism'}
+    assert json.loads(message.with_return(return_message)) == dict(message, **return_message)
+    assert message.fragment().startswith(group_message.fragment())
+    assert json.loads(AdjustMessage().with_return(return_message)) == return_message
+    rebuilt = phase_message(AdjustMessage(json.loads(json.dumps(group_message))), message[MEASUREMENTS])
+    assert message.digest() == rebuilt.digest()
+    assert message.digest() != phase_message(group_message, []).digest()
+    assert AdjustMessage(message).digest() == AdjustMessage(json.loads(json.dumps(message))).digest()
+
+
+def test_metrics():
+    cache = TTLCache(10, 60)
+    watch_cache('test_cache', cache)
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+    with observe_stage('test_stage'):
+        pass
+    update_worker_gauges()
+    text = generate_latest().decode()
+    assert 'iloop_to_model_cache_hits{cache="test_cache"} 1.0' in text
+    assert 'iloop_to_model_cache_misses{cache="test_cache"} 1.0' in text
+    assert 'iloop_to_model_stage_seconds_count{stage="test_stage"} 1.0' in text
+
+
+@pytest.mark.asyncio
+async def test_tracing():
+    assert span('iloop') is span('model')
+    trace = Trace()
+    current_trace.set(trace)
+    try:
+        with span('iloop', 'load_sample'):
+            pass
+        await asyncio.gather(traced('tmy', asyncio.sleep(0.01), 'wild type'), traced('tmy', asyncio.sleep(0)))
+    finally:
+        current_trace.set(None)
+    assert [(s.name, s.detail) for s in trace.spans] == [('iloop', 'load_sample'), ('tmy', ''), ('tmy', 'wild_type')]
+    assert trace.server_timing().startswith('iloop;desc="1x";dur=0.0, tmy;desc="2x";dur=1')
+    assert trace.timeline().split(' ')[0] == 'iloop:load_sample@0+0'
+
+
 def test_name_groups():
     sample_groups = [[s1], [s2], [s3]]
     unique_keys = [
@@ -135,3 +319,465 @@ def test_name_groups():
     unique_keys = [(1, 1, 1, 1)]
     names = [('A', 'B', 'C', 'D')]
     assert name_groups(sample_groups, unique_keys, names)[0].name == 'A, D'
+
+
+@pytest.mark.asyncio
+async def test_sample_groups_for_experiment():
+    groups = await sample_groups_for_experiment(GroupingIloop, 1)
+    assert [(list(group.id), group.name, group.organism) for group in groups] == [
+        ([1, 2, 3], 'P1, M1, ', 'ECO'),
+        ([5], 'P1, M2, M3', 'ECO'),
+        ([4], 'P2, M1, ', 'SCE'),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_sample_groups_resolve_in_iloop_threads(monkeypatch):
+    threads = []
+
+    def resolve(entity):
+        threads.append(threading.current_thread().name)
+        return entity
+
+    monkeypatch.setattr(iloop_entities, 'resolve', resolve)
+    await sample_groups_for_experiment(GroupingIloop, 1)
+    assert threads and all(name.startswith('iloop') for name in threads)
+
+
+@pytest.mark.asyncio
+async def test_fetch_samples():
+    class Iloop:
+        Sample = {1: s1, 2: s2, 3: s3}.get
+
+    assert await fetch_samples(Iloop, [3, 1, 2]) == [s3, s1, s2]
+
+
+def test_cache_key():
+    assert cache_key('iJO1366', {'a': 1, 'b': [1, 2]}) == cache_key('iJO1366', {'b': [1, 2], 'a': 1})
+    assert cache_key('iJO1366', {'a': 1}) != cache_key('iMM904', {'a': 1})
+
+
+def test_ttl_cache():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.hits == 3 and cache.misses == 1
+    expired = TTLCache(maxsize=2, ttl=-1)
+    expired.set('a', 1)
+    assert expired.get('a') is None
+    sized = TTLCache(maxsize=10, ttl=60, maxbytes=100)
+    sized.set('a', 1, 60)
+    sized.set('b', 2, 30)
+    sized.set('c', 3, 30)
+    assert 'a' not in sized and sized.bytes == 60
+    sized.set('d', 4, 200)
+    assert 'd' not in sized and len(sized) == 2
+
+
+@pytest.mark.asyncio
+async def test_result_cache_bytes():
+    results = ResultCache(TTLCache(maxsize=10, ttl=60, maxbytes=1000))
+    await results.set('fluxes', {'fluxes': {'R1': 1.0}}, 20)
+    await results.set('model', {'model': 'x' * 1000}, 1012)
+    assert await results.get('fluxes') == {'fluxes': {'R1': 1.0}}
+    assert await results.get('model') is None
+
+
+@pytest.mark.asyncio
+async def test_wild_type_tmy(monkeypatch):
+    calls = []
+
+    async def tmy(model_id, adjust_message, objectives):
+        calls.append(objectives)
+        return {'model_id': model_id, 'tmy': {o: {'objective': o} for o in objectives}}
+
+    monkeypatch.setattr(iloop_to_model.iloop_to_model, 'tmy', tmy)
+    first, second = await asyncio.gather(wild_type_tmy('test-model', ['chebi:1', 'chebi:2']),
+                                         wild_type_tmy('test-model', ['chebi:2']))
+    assert first == {'chebi:1': {'objective': 'chebi:1'}, 'chebi:2': {'objective': 'chebi:2'}}
+    assert second == {'chebi:2': {'objective': 'chebi:2'}}
+    assert await wild_type_tmy('test-model', ['chebi:3', 'chebi:1']) == {
+        'chebi:3': {'objective': 'chebi:3'}, 'chebi:1': {'objective': 'chebi:1'}}
+    assert sorted(chain(*calls)) == ['chebi:1', 'chebi:2', 'chebi:3']
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    calls = []
+
+    async def call(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    single_flight = SingleFlight()
+    results = await asyncio.gather(*[single_flight.do(key, call, key) for key in ['a', 'a', 'b', 'a']])
+    assert results == ['a', 'a', 'b', 'a']
+    assert sorted(calls) == ['a', 'b']
+    assert single_flight.calls == 4 and single_flight.coalesced == 2
+    assert await single_flight.do('a', call, 'a') == 'a'
+    assert len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancelled():
+    cancelled = []
+
+    async def call():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    single_flight = SingleFlight()
+    first, second = [asyncio.ensure_future(single_flight.do('a', call)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    first.cancel()
+    await asyncio.sleep(0.01)
+    assert not cancelled and len(single_flight) == 1
+    second.cancel()
+    await asyncio.sleep(0.01)
+    assert cancelled == [True] and len(single_flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_budgets(monkeypatch):
+    budgets = []
+
+    async def make_request(model_id, message, read_response):
+        await asyncio.sleep(0.05)
+        budgets.append(remaining())
+        await asyncio.sleep(0.05)
+        return {'model-id': model_id, 'fluxes': {'R1': 1.0}}, 40
+
+    async def caller(timeout, adjust_message):
+        scope, limiter, trace = RequestScope(timeout), Limiter(1), Trace()
+        request_scope.set(scope)
+        request_limiter.set(limiter)
+        current_trace.set(trace)
+        try:
+            return await fluxes('iJO1366', adjust_message)
+        finally:
+            scope.cancel()
+            assert limiter.total == 1 and [s.name for s in trace.spans] == ['model']
+
+    monkeypatch.setattr(iloop_to_model.iloop_to_model, 'make_request', make_request)
+    short = asyncio.ensure_future(caller(0.02, {'budgets': 1}))
+    await asyncio.sleep(0)
+    assert (await caller(60, {'budgets': 1}))['fluxes'] == {'R1': 1.0}
+    with pytest.raises(DeadlineExceeded):
+        await short
+    assert len(budgets) == 1 and 59 < budgets[0] < 60
+
+    async def limited():
+        request_limiter.set(Limiter(1))
+        await asyncio.gather(*[fluxes('iJO1366', {'budgets': i}) for i in range(2, 5)])
+        return request_limiter.get()
+
+    limiter = await asyncio.ensure_future(limited())
+    assert limiter.total == 3 and limiter.queued == 2
+
+
+@pytest.mark.asyncio
+async def test_limiter():
+    limiter = Limiter(2)
+    running = []
+
+    async def call():
+        async with limiter:
+            running.append(limiter.running)
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[call() for _ in range(5)])
+    assert max(running) == 2
+    assert limiter.total == 5 and limiter.queued == 3
+    assert limiter.running == 0 and limiter.waiting == 0
+
+
+def test_request_rate():
+    rate = RequestRate(100)
+    start = time.monotonic()
+    threads = [threading.Thread(target=rate.wait) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start >= 0.04
+
+
+@pytest.mark.asyncio
+async def test_request_scope():
+    scope = RequestScope(60)
+    assert 59 < scope.remaining() <= 60
+    scope.check()
+    with pytest.raises(DeadlineExceeded):
+        RequestScope(-1).check()
+    assert RequestScope().remaining() is None
+    request_scope.set(scope)
+    await run_iloop(check_scope)
+    scope.cancel()
+    with pytest.raises(RequestCancelled):
+        await run_iloop(check_scope)
+
+
+@pytest.mark.asyncio
+async def test_gather_cancelling():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        raise ValueError()
+
+    assert await gather_cancelling(asyncio.sleep(0, 'a'), asyncio.sleep(0, 'b')) == ['a', 'b']
+    with pytest.raises(ValueError):
+        await gather_cancelling(slow(), fail())
+    await asyncio.sleep(0.01)
+    assert cancelled == [True]
+
+
+@pytest.mark.asyncio
+async def test_stream_sample_model(monkeypatch):
+    result = {'model': {}, 'model_id': 'iJO1366', 'growth-rate': 0.5}
+
+    async def phases(last):
+        yield 'phase1', result
+        await last()
+        yield 'phase2', result
+
+    async def fail():
+        raise ModelServiceError()
+
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def sample_in_phases_stream(request, iloop, function_for_phase):
+        return phases(last)
+
+    async def post(body):
+        app = web.Application(middlewares=[deadline_middleware])
+        app.router.add_post('/stream', stream_sample_model)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post('/stream', data=body)
+            return response.status, [json.loads(line) for line in (await response.read()).splitlines()]
+
+    async def iloop_from_context(context):
+        return None
+
+    monkeypatch.setattr(iloop_to_model.app, 'iloop_from_context', iloop_from_context)
+    monkeypatch.setattr(iloop_to_model.app, 'sample_in_phases_stream', sample_in_phases_stream)
+    status, lines = await post(b'{"sample_ids": ')
+    assert status == 400 and lines[0]['status'] == 400
+    last = fail
+    status, lines = await post(b'{}')
+    assert status == 200 and lines[0]['phaseId'] == 'phase1'
+    assert lines[1]['error']['status'] == 502
+    last = slow
+    monkeypatch.setattr(stream_sample_model, 'request_timeout', 0.1)
+    status, lines = await post(b'{}')
+    assert status == 200 and lines[0]['phaseId'] == 'phase1'
+    assert lines[1]['error']['status'] == 504
+
+
+@pytest.mark.asyncio
+async def test_deadline_middleware(monkeypatch):
+    async def slow(request):
+        with span('model'):
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(Default, 'REQUEST_TIMEOUT', 0.05)
+    app = web.Application(middlewares=[metrics_middleware, tracing_middleware, deadline_middleware])
+    app.router.add_get('/slow', slow)
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get('/slow', headers={'X-Trace': '1'})
+        assert response.status == 504
+        assert (await response.json())['status'] == 504
+        assert response.headers['Server-Timing'].startswith('model;desc="1x"')
+        assert response.headers['X-Trace'].startswith('model@')
+    assert 'iloop_to_model_request_seconds_count{endpoint="/slow",status="504"} 1.0' in generate_latest().decode()
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(2, 0)
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.open and breaker.allow()
+    breaker.failure()
+    assert breaker.open
+    assert breaker.allow() and not breaker.allow()
+    assert breaker.rejected == 1
+    breaker.failure()
+    assert breaker.open and breaker.allow()
+    breaker.success()
+    assert not breaker.open and breaker.allow() and breaker.allow()
+    breaker = CircuitBreaker(1, 60)
+    breaker.failure()
+    assert not breaker.allow()
+
+
+@pytest.mark.asyncio
+async def test_call_model_service(monkeypatch):
+    class Response:
+        def __init__(self, status):
+            self.status = status
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            pass
+
+        async def text(self):
+            return 'error'
+
+    class Session:
+        def __init__(self, statuses):
+            self.statuses = list(statuses)
+
+        def request(self, method, url, timeout, **kwargs):
+            return Response(self.statuses.pop(0))
+
+    async def read(r):
+        return r.status
+
+    monkeypatch.setattr(iloop_to_model.upstream, 'model_breaker', CircuitBreaker(0, 0))
+    monkeypatch.setattr(iloop_to_model.upstream, 'backoff', lambda attempt: 0)
+    session = Session([503, 502, 200])
+    monkeypatch.setattr(iloop_to_model.upstream, 'model_session', lambda: session)
+    assert await call_model_service('POST', 'url', read) == 200
+    session.statuses = [503, 200]
+    with pytest.raises(ModelServiceError):
+        await call_model_service('POST', 'url', read, idempotent=False)
+    session.statuses = [400, 200]
+    with pytest.raises(ModelServiceError):
+        await call_model_service('POST', 'url', read)
+    monkeypatch.setattr(iloop_to_model.upstream, 'remaining', lambda: 0)
+    with pytest.raises(ModelServiceTimeout):
+        await call_model_service('POST', 'url', read)
+
+
+@pytest.mark.asyncio
+async def test_experiment_index():
+    experiment = namedtuple('Experiment', ['id', 'read_samples'])
+    yeast_sample = Sample(4, Strain(Organism('SCE'), None, pool, None, ''), medium, None, lambda: [], 'S4', None,
+                          experiment_aerobic)
+    scanned = []
+
+    def read_samples(experiment_id, samples):
+        def read():
+            scanned.append(experiment_id)
+            return samples
+        return read
+
+    class Iloop:
+        class Experiment:
+            experiments = [experiment(1, read_samples(1, [s1, s2])), experiment(2, read_samples(2, [s3, yeast_sample]))]
+
+            @classmethod
+            def instances(cls, where):
+                return cls.experiments
+
+    index = ExperimentIndex(ttl=60)
+    assert [e.id for e in await index.experiments_for_taxon(Iloop, 'ECOLX')] == [1, 2]
+    assert [e.id for e in await index.experiments_for_taxon(Iloop, 'YEAST')] == [2]
+    Iloop.Experiment.experiments.append(experiment(3, read_samples(3, [yeast_sample])))
+    assert [e.id for e in await index.experiments_for_taxon(Iloop, 'YEAST')] == [2, 3]
+    assert sorted(scanned) == [1, 2, 3]
+
+    def fail():
+        time.sleep(0.05)
+        raise ValueError()
+
+    index, scanned[:] = ExperimentIndex(ttl=60), []
+    with pytest.raises(ValueError):
+        await index.update([experiment(1, read_samples(1, [s1])), experiment(2, fail)])
+    assert index.is_current(1) and not index.is_current(2)
+    assert await index.update(Iloop.Experiment.experiments) == 2
+    assert sorted(scanned) == [1, 2, 3]
+
+
+def potion_resource(token, documents, fetched, name='Entity'):
+    """A potion resource class whose client reads the given documents by uri and records what was fetched"""
+    class Client:
+        _api_root_url = 'http://iloop/api'
+        _instances = {}
+        session = namedtuple('Session', ['auth'])(namedtuple('Auth', ['token'])(token))
+
+        def fetch(self, uri, uri_to_instance):
+            fetched.append((token, uri))
+            return dict(documents[uri], **{'$uri': uri})
+
+    def __getattr__(self, item):
+        return self[item]
+
+    return type(name, (Resource,), {'_client': Client(), '__getattr__': __getattr__})
+
+
+def test_entity_cache():
+    fetched = []
+    documents = {'/api/strain/1': {'genotype': '+Aac'}}
+    strain_a, strain_b = potion_resource('a', documents, fetched), potion_resource('b', documents, fetched)
+    cache = EntityCache(maxsize=10, ttl=60)
+    assert cache.resolve(strain_a('/api/strain/1'))['genotype'] == '+Aac'
+    assert cache.resolve(strain_a('/api/strain/1'))['genotype'] == '+Aac'
+    assert cache.resolve(strain_b('/api/strain/1'))['genotype'] == '+Aac'
+    assert fetched == [('a', '/api/strain/1'), ('b', '/api/strain/1')]
+    assert cache.hits == 1 and cache.misses == 2
+    assert cache.resolve(None) is None and cache.resolve(strain) is strain
+
+
+def test_lineage():
+    parent_pool = Pool(None, '+parent_pool_gene')
+    child_pool = Pool(parent_pool, '')
+    parent = Strain(organism, None, parent_pool, None, '+Bbc')
+    child = Strain(organism, parent, child_pool, None, '+Aac')
+    assert strain_lineage(child) == [parent_pool, child_pool, parent, child]
+    assert extract_genotype_changes(child) == ['+parent_pool_gene', '+Bbc', '+Aac']
+
+
+def test_lineage_memoized():
+    fetched = []
+    documents = {}
+    pool_ = potion_resource('token', documents, fetched, 'Pool')
+    strain_ = potion_resource('token', documents, fetched, 'Strain')
+    documents['/api/pool/1'] = {'parent_pool': None, 'genotype': '+pool_gene'}
+    documents['/api/strain/1'] = {'parent_strain': None, 'pool': pool_('/api/pool/1'), 'genotype': '+Aac'}
+    documents['/api/strain/2'] = {'parent_strain': strain_('/api/strain/1'), 'pool': pool_('/api/pool/1'),
+                                  'genotype': '+Bbc'}
+    documents['/api/strain/3'] = {'parent_strain': strain_('/api/strain/1'), 'pool': pool_('/api/pool/1'),
+                                  'genotype': ''}
+    assert extract_genotype_changes(strain_('/api/strain/2')) == ['+pool_gene', '+Aac', '+Bbc']
+    assert extract_genotype_changes(strain_('/api/strain/3')) == ['+pool_gene', '+Aac']
+    assert sorted(uri for _, uri in fetched) == ['/api/pool/1', '/api/strain/1', '/api/strain/2', '/api/strain/3']
+
+
+@pytest.mark.asyncio
+async def test_warmer(monkeypatch):
+    class Iloop:
+        class Experiment:
+            def __init__(self, experiment_id):
+                if experiment_id == 2:
+                    raise KeyError(experiment_id)
+
+            def read_samples(self):
+                return [s1, s2]
+
+    monkeypatch.setattr(iloop_to_model.warmup, 'iloop_client', lambda api, token: Iloop)
+    warmer = Warmer({'active'}, experiments=2, rate=1000)
+    for experiment_id in [1, 2, 3]:
+        warmer.record('api', 'token', experiment_id)
+    await warmer.warm()
+    assert warmer.status['experiments_total'] == 2
+    assert warmer.status['experiments_warmed'] == 1
+    assert warmer.status['errors'] == 1
+    assert warmer.status['rounds'] == 1 and not warmer.status['running']